@@ -0,0 +1,234 @@
+import numpy as np
+
+
+class SearchBudgetExceeded(Exception):
+    """
+    the branch and bound search took more steps than its budget
+    """
+
+
+def bitset_adjacency(n: int, rows: np.ndarray, cols: np.ndarray) -> list:
+    """
+    adjacency of an undirected graph of n nodes as python integers used as bitsets: bit j of adj[i] is set if (i, j) is an edge
+    """
+    rows, cols = np.concatenate([rows, cols]), np.concatenate([cols, rows])
+    order = np.argsort(rows, kind='stable')
+    rows, cols = rows[order], cols[order]
+    bounds = np.searchsorted(rows, np.arange(n + 1))
+    words = (n + 63) // 64
+    adj = []
+    for i in range(n):
+        neighbours = cols[bounds[i]:bounds[i + 1]]
+        bits = np.zeros(words, dtype=np.uint64)
+        np.bitwise_or.at(bits, neighbours >> 6, np.left_shift(
+            np.uint64(1), (neighbours & 63).astype(np.uint64)))
+        adj.append(int.from_bytes(bits.tobytes(), 'little'))
+    return adj
+
+
+def connected_components(n: int, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+    """
+    component label of each node (its smallest node) by hooking the roots of the edges to the smallest one
+    and pointer jumping, until the two ends of every edge have the same root
+    """
+    labels = np.arange(n)
+    while True:
+        roots = np.minimum(labels[rows], labels[cols])
+        hooked = labels.copy()
+        np.minimum.at(hooked, labels[rows], roots)
+        np.minimum.at(hooked, labels[cols], roots)
+        while True:
+            jumped = hooked[hooked]
+            if (jumped == hooked).all():
+                break
+            hooked = jumped
+        if (hooked == labels).all():
+            return labels
+        labels = hooked
+
+
+def nodes_of(bitset: int) -> list:
+    """
+    positions of the set bits, in increasing order
+    """
+    nodes = []
+    while bitset:
+        low = bitset & -bitset
+        nodes.append(low.bit_length() - 1)
+        bitset ^= low
+    return nodes
+
+
+def __color_sort__(adj: list, weights: list, candidates: int) -> tuple:
+    """
+    greedy coloring of the candidates: nodes are listed by increasing color, the bound of a node is the sum of the
+    heaviest weight of each color class listed up to it, which bounds the weight of a clique among these nodes
+    """
+    order, bounds = [], []
+    total = 0
+    uncolored = candidates
+    while uncolored:
+        available = uncolored
+        heaviest = 0
+        while available:
+            low = available & -available
+            v = low.bit_length() - 1
+            available &= ~adj[v] & ~low
+            uncolored ^= low
+            heaviest = max(heaviest, weights[v])
+            order.append(v)
+            bounds.append(total + heaviest)
+        total += heaviest
+    return order, bounds
+
+
+def maximum_clique(adj: list, weights: list, candidates: int, upper: int = None, budget: int = None) -> tuple:
+    """
+    Branch and bound maximum weight clique among the candidates (bitset), with greedy coloring bounds (Tomita's MCQ).
+    The search is iterative, so the clique size is not limited by the recursion depth, and deterministic:
+    among the heaviest cliques, the first one found in the order of the node positions is returned.
+    If upper is given (a known bound of the clique weight), the search stops as soon as a clique of that weight is found.
+    If budget is given, SearchBudgetExceeded is raised after budget steps (branches of the search)
+    Returns the sorted nodes of the clique, its weight and the number of steps
+    """
+    best, best_weight = [], 0
+    steps = 0
+    order, bounds = __color_sort__(adj, weights, candidates)
+    stack = [[[], 0, order, bounds, candidates]]
+    while stack:
+        frame = stack[-1]
+        clique, weight, order, bounds, P = frame
+        if not order or weight + bounds[-1] <= best_weight:
+            stack.pop()
+            continue
+        v = order.pop()
+        bounds.pop()
+        frame[4] = P & ~(1 << v)
+        new_P = P & adj[v]
+        if new_P:
+            steps += 1
+            if budget is not None and steps > budget:
+                raise SearchBudgetExceeded(steps)
+            stack.append([clique + [v], weight + weights[v],
+                         *__color_sort__(adj, weights, new_P), new_P])
+        elif weight + weights[v] > best_weight:
+            best, best_weight = clique + [v], weight + weights[v]
+            if upper is not None and best_weight >= upper:
+                break
+    return sorted(best), best_weight, steps
+
+
+def greedy_cliques(adj: list, weights: list, candidates: int) -> list:
+    """
+    Greedy clique cover of the candidates (a greedy coloring of the complement graph), in O(n^2) bitset operations:
+    in order of decreasing weight, each node not covered yet starts a clique, extended by the next nodes in the same order
+    adjacent to all of its nodes. Returns the cliques of weight at least 2 as sorted lists of node positions
+    """
+    order = sorted(nodes_of(candidates), key=lambda v: -weights[v])
+    clusters = []
+    for v in order:
+        if not candidates >> v & 1:
+            continue
+        clique, P = [v], candidates & adj[v]
+        for u in order:
+            if not P:
+                break
+            if P >> u & 1:
+                clique.append(u)
+                P &= adj[u]
+        for u in clique:
+            candidates &= ~(1 << u)
+        if sum(weights[u] for u in clique) >= 2:
+            clusters.append(sorted(clique))
+    return clusters
+
+
+def clique_partition(n: int, rows: np.ndarray, cols: np.ndarray, weights: np.ndarray = None, budget: int = None) -> tuple:
+    """
+    Partition the nodes of a graph (n nodes, edges (rows[e], cols[e])) into cliques: the heaviest clique is recorded
+    and removed, and the search is repeated on the remaining graph until no clique of weight 2 is left.
+    Without weights every node weights 1, so the heaviest clique is the biggest one.
+    Cliques are found by branch and bound instead of enumerating all maximal cliques at every step, and since the clique
+    weight can only decrease when nodes are removed, the weight of the previous clique bounds the next search.
+    If the searches take more than budget steps in total, the nodes left are covered by greedy_cliques instead.
+    Returns the cliques (of weight at least 2) as sorted lists of node positions, None or, if the budget was
+    exceeded, the fallback: the number of cliques found exactly and greedily, the nodes left to the greedy cover, the
+    weight of its heaviest clique and the bound of the heaviest clique left (the exact search could do up to that),
+    and the number of steps of the searches
+    """
+    weights = [1] * n if weights is None else [int(w) for w in weights]
+    adj = bitset_adjacency(n, rows, cols)
+    remaining = 0
+    for v in range(n):
+        if adj[v] or weights[v] > 1:
+            remaining |= 1 << v
+
+    clusters = []
+    upper = None
+    steps = 0
+    while remaining:
+        try:
+            clique, weight, work = maximum_clique(adj, weights, remaining, upper,
+                                                  None if budget is None else budget - steps)
+        except SearchBudgetExceeded:
+            _, bounds = __color_sort__(adj, weights, remaining)
+            greedy = greedy_cliques(adj, weights, remaining)
+            fallback = {'exact_clusters': len(clusters),
+                        'fallback_clusters': len(greedy),
+                        'fallback_nodes': remaining.bit_count(),
+                        'fallback_weight': max((sum(weights[v] for v in c) for c in greedy), default=0),
+                        'bound': min(bounds[-1], upper) if upper is not None else bounds[-1]}
+            return clusters + greedy, fallback, budget
+        steps += work
+        if weight < 2:
+            break
+        clusters.append(clique)
+        upper = weight
+        for v in clique:
+            remaining &= ~(1 << v)
+        # nodes left without neighbours are only a cluster by themselves
+        for v in nodes_of(remaining):
+            if weights[v] < 2 and not adj[v] & remaining:
+                remaining &= ~(1 << v)
+    return clusters, None, steps
+
+
+def component_partition(n: int, rows: np.ndarray, cols: np.ndarray, weights: np.ndarray = None,
+                        diameter: int = None) -> list:
+    """
+    Partition the nodes of a graph into connected components (single linkage), in near linear time.
+    With a diameter cap, a component is split into balls: the heaviest node left (the first one on ties) and the nodes
+    left within diameter // 2 edges of it are recorded and removed, so two nodes of a cluster are at most diameter
+    edges apart, until every node is in a ball.
+    Returns the clusters (of weight at least 2) as sorted lists of node positions
+    """
+    weights = np.ones(n, dtype=np.int64) if weights is None else np.asarray(weights, dtype=np.int64)
+    if diameter is None:
+        labels = connected_components(n, rows, cols)
+        order = np.argsort(labels, kind='stable')
+        bounds = np.flatnonzero(np.diff(labels[order])) + 1
+        return [c.tolist() for c in np.split(order, bounds) if weights[c].sum() >= 2]
+
+    rows, cols = np.concatenate([rows, cols]), np.concatenate([cols, rows])
+    order = np.argsort(rows, kind='stable')
+    neighbours = cols[order]
+    bounds = np.searchsorted(rows[order], np.arange(n + 1))
+    remaining = np.ones(n, dtype=bool)
+    clusters = []
+    for center in np.argsort(-weights, kind='stable'):
+        if not remaining[center]:
+            continue
+        ball, frontier = [center], np.array([center])
+        remaining[center] = False
+        for _ in range(diameter // 2):
+            frontier = np.unique(np.concatenate(
+                [neighbours[bounds[v]:bounds[v + 1]] for v in frontier]))
+            frontier = frontier[remaining[frontier]]
+            if len(frontier) == 0:
+                break
+            remaining[frontier] = False
+            ball.extend(frontier.tolist())
+        # a ball lighter than 2 is a node of weight 1 without neighbours left
+        if weights[ball].sum() >= 2:
+            clusters.append(sorted(ball))
+    return clusters
@@ -0,0 +1,122 @@
+import argparse
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather
+from group_reader import format_sample_index
+from patients import patient_sets
+
+
+def cluster_name(df: pd.DataFrame) -> str:
+    """
+    name of a cluster, from the v_call, j_call and junction_aa of its first record
+    """
+    first = df.iloc[0]
+    return f"{first['v_call']}_{first['j_call']}_{first['junction_aa']}"
+
+
+class ClusterStore():
+    """
+    Clusters of a clustering stage in one table, clustering_{name}/clusters.feather: the records of every cluster with
+    its cluster_id and patient_count, sorted by cluster_id (the records of a cluster are contiguous).
+    The per-cluster csv files clusters/{patient_count}/{v_call}_{j_call}_{junction_aa}.csv can be exported from it,
+    without the columns only used by the store (store_columns)
+    """
+    # patient_code is the integer code of patient_id (see patients.csv), used for the patient sets
+    store_columns = ['patient_code']
+
+    def __init__(self, clustering_path: Path) -> None:
+        self.clustering_path = Path(clustering_path)
+        self.store_path = self.clustering_path.joinpath("clusters.feather")
+
+    def write(self, members: list) -> int:
+        """
+        write the clusters (one dataframe of records with their patient_count per cluster) in bulk,
+        the cluster_id is the position in the list. Returns the number of clusters
+        """
+        if not members:
+            return self.write_records(None)
+        df = pd.concat(members, ignore_index=True)
+        df.insert(0, 'cluster_id', np.repeat(
+            np.arange(len(members)), [len(i) for i in members]))
+        return self.write_records(df)
+
+    def write_records(self, df: pd.DataFrame) -> int:
+        """
+        write the records of all the clusters, with their cluster_id and patient_count columns, sorted by cluster_id.
+        Returns the number of clusters
+        """
+        if df is None or df.empty:
+            self.store_path.unlink(missing_ok=True)
+            return 0
+        df = df[['cluster_id', 'patient_count'] +
+                [c for c in df.columns if c not in ('cluster_id', 'patient_count')]]
+        temp_path = self.store_path.with_name(self.store_path.name + ".tmp")
+        pyarrow.feather.write_feather(pa.Table.from_pandas(
+            df, preserve_index=False), temp_path, compression='lz4')
+        temp_path.replace(self.store_path)
+        return df['cluster_id'].nunique()
+
+    def exists(self) -> bool:
+        return self.store_path.is_file()
+
+    def read(self, columns: list = None) -> pd.DataFrame:
+        """
+        records of all the clusters
+        """
+        return pd.read_feather(self.store_path, columns=columns)
+
+    def cluster(self, cluster_id: int) -> pd.DataFrame:
+        """
+        records of one cluster, found by binary search on the sorted cluster_id column
+        """
+        table = pyarrow.feather.read_table(self.store_path, memory_map=True)
+        ids = table['cluster_id'].to_numpy()
+        start, stop = np.searchsorted(ids, [cluster_id, cluster_id + 1])
+        return table.slice(start, stop - start).to_pandas()
+
+    def clusters(self):
+        """
+        iterate over the clusters: (cluster_id, patient_count, records)
+        """
+        if not self.exists():
+            return
+        df = self.read()
+        for cluster_id, records in df.groupby('cluster_id', sort=True):
+            yield cluster_id, int(records['patient_count'].iloc[0]), records.drop(['cluster_id', 'patient_count'], axis=1)
+
+    def patient_sets(self) -> pd.Series:
+        """
+        patient set (bitset of patient codes) of each cluster, indexed by cluster_id.
+        Clusters sharing patients can be found with patients.patient_overlap
+        """
+        df = self.read(['cluster_id', 'patient_code'])
+        ids, groups = np.unique(df['cluster_id'].to_numpy(), return_inverse=True)
+        return pd.Series(patient_sets(df['patient_code'].to_numpy(), groups, len(ids)), index=ids, dtype=object, name='patients')
+
+    def export_csv(self, cluster_path: Path = None) -> Path:
+        """
+        write one csv file per cluster in cluster_path/{patient_count}/{v_call}_{j_call}_{junction_aa}.csv
+        with the columns of data_clean.feather except store_columns, the csv files of a previous export are removed
+        """
+        cluster_path = Path(cluster_path) if cluster_path else self.clustering_path.joinpath("clusters")
+        for f in cluster_path.glob("*/*.csv"):
+            f.unlink()
+        for _, patient_count, records in self.clusters():
+            out_path = cluster_path.joinpath(str(patient_count))
+            out_path.mkdir(parents=True, exist_ok=True)
+            records = records.drop(self.store_columns, axis=1, errors='ignore')
+            format_sample_index(records).to_csv(
+                out_path.joinpath(cluster_name(records)+".csv"), index=False)
+        return cluster_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Export the clusters of a clustering stage as one csv file per cluster')
+    parser.add_argument('input',
+                        type=str,
+                        help='clustering directory path (containing clusters.feather)')
+    args = parser.parse_args()
+    ClusterStore(Path(args.input)).export_csv()
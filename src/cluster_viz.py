@@ -6,21 +6,15 @@ import numpy as np
 from itertools import combinations
 from tqdm import tqdm
 import plotly.graph_objects as go
+from similarity import similar_pairs, blosum_groups, same_group
+from sequence_store import encode_junctions
+from cluster_store import ClusterStore
 
 
 def main(args):
-    blosum = pd.read_csv(
-        "/rsrch4/home/mol_cgenesis/nkdang/CDR3/reference/BLOSUM62.csv")
+    blosum = pd.read_csv(args.aminoacid)
     blosum = blosum.astype(int)
-
-    def check_group(s1, s2):
-        for i, _ in enumerate(s1):
-            if blosum.loc[s1[i], s2[i]] <= 0:
-                return False
-        return True
-
-    def hamstring_similarity(x, y):
-        return sum([c1 == c2 for c1, c2 in zip(list(x), list(y))])/len(x)
+    groups = blosum_groups(blosum)
 
     # from plotly.colors import n_colors
     # cluster_size = sorted([int(i.stem) for i in list(Path("/rsrch4/home/mol_cgenesis/EMC_BIC_rsrch4/nkdang/CDR3/results/SKCM/heavy/clustering_convergence/clusters").glob("*"))])
@@ -31,39 +25,36 @@ def main(args):
     in_dir = Path(args.input)
     cancer = in_dir.parent.parent.name
     cluster_type = in_dir.name
+    store = ClusterStore(in_dir)
     in_dir = in_dir.joinpath("clusters")
     G = nx.Graph()
 
     cluster_counter = 1
 
-    for file in tqdm(in_dir.glob("**/*.csv"), total=len(list(in_dir.glob("**/*.csv")))):
-        temp = pd.read_csv(file)
+    for _, patient_count, temp in tqdm(store.clusters(), total=store.read(['cluster_id'])['cluster_id'].nunique()):
         # print(temp)
         # if temp.empty:
         #     continue
         # temp = temp.drop(['sample_id', 'row_index'], axis=1)
-        temp['patient_count'] = file.parent.name
+        temp['patient_count'] = str(patient_count)
         temp['vdj_count'] = len(temp)
         temp['name'] = temp['patient_id']+"_"+temp["v_call"] + \
             "_"+temp["j_call"]+"_"+temp["junction_aa"]
         temp['cluster'] = cluster_counter
         G.add_edges_from([(i, j) for i, j in list(combinations(temp['name'], 2))], cluster=str(
-            cluster_counter), cluster_size=file.parent.stem)
+            cluster_counter), cluster_size=str(patient_count))
         nx.set_node_attributes(G, temp.set_index('name').to_dict('index'))
         cluster_counter += 1
-    filters = [lambda x: not G.has_edge(x[0][0], x[1][0]),
-               lambda x: len(x[0][1]['junction_aa']) == len(
-                   x[1][1]['junction_aa']),
-               lambda x: x[0][1]['v_call'] == x[1][1]['v_call'],
-               lambda x: x[0][1]['j_call'] == x[1][1]['j_call'],
-               lambda x: check_group(
-                   x[0][1]['junction_aa'], x[1][1]['junction_aa']),
-               lambda x: hamstring_similarity(x[0][1]['junction_aa'], x[1][1]['junction_aa']) >= 0.8]
-    result = combinations(list(G.nodes(data=True)), 2)
-    for f in filters:
-        result = filter(f, result)
-    result = list(result)
-    G.add_edges_from([(i[0][0], i[1][0]) for i in result], cluster='0')
+    # convergent pairs of nodes of same v_call, j_call and junction_aa length, not already linked by a cluster
+    nodes = pd.DataFrame.from_dict(dict(G.nodes(data=True)), orient='index')
+    result = []
+    for _, temp in nodes.groupby([nodes['v_call'], nodes['j_call'], nodes['junction_aa'].str.len()]):
+        matrix = encode_junctions(temp['junction_aa'], len(temp['junction_aa'].iloc[0]))
+        rows, cols, _ = similar_pairs(matrix, 0.8)
+        convergent = same_group(matrix, rows, cols, groups)
+        result += [(i, j) for i, j in zip(temp.index[rows[convergent]], temp.index[cols[convergent]])
+                   if not G.has_edge(i, j)]
+    G.add_edges_from(result, cluster='0')
 
     # nx.set_node_attributes(G, {k:{"pos":v} for k,v in nx.shell_layout(G).items()})
     nx.set_node_attributes(
@@ -139,5 +130,9 @@ if __name__ == "__main__":
     parser.add_argument('input',
                         type=str,
                         help='input directory path')
+    parser.add_argument('-a', '--aminoacid',
+                        type=str,
+                        default="/rsrch4/home/mol_cgenesis/nkdang/CDR3/reference/BLOSUM62.csv",
+                        help='amino acid group mapper')
     args = parser.parse_args()
     main(args)
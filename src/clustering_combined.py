@@ -0,0 +1,112 @@
+import logging
+import pandas as pd
+
+from clustering_similar import ClusteringSimilar
+from clustering_convergence import ClusteringConvergence
+from similarity import similar_pairs, max_mismatches
+from scheduler import Scheduler
+from patients import patient_set, patient_count
+
+
+class ClusteringCombined():
+    """
+    Similar and convergence clustering in one pass over the (v_call, j_call, junction_aa_length) groups:
+    the hamming similarity graph of a group is computed once, the convergence graph is its subgraph
+    of edges having the same amino acid groups at all positions
+    With several similarity thresholds (sweep), the pairs and their number of mismatches are computed once at the lowest
+    threshold and the graphs of every threshold are derived from them. The clusterings of each threshold are written
+    to outdir/similarity_{threshold}, and the cluster counts and patient coverage of all of them to similarity_sweep.csv
+    """
+
+    def __init__(self, data_clean_path, patient_min,
+                 blosum, similarity_threshold, outdir, cluster_mode='clique', diameter=None,
+                 clique_budget=None, prune_nodes=False, workers=None) -> None:
+        thresholds = sorted(set(similarity_threshold)) if isinstance(
+            similarity_threshold, (list, tuple)) else [similarity_threshold]
+        self.sweep = len(thresholds) > 1
+        self.outdir = outdir
+        self.stages = []
+        for threshold in thresholds:
+            stage_outdir = outdir.joinpath(f"similarity_{threshold:g}") if self.sweep else outdir
+            stage_outdir.mkdir(parents=True, exist_ok=True)
+            self.stages.append((ClusteringSimilar(data_clean_path, patient_min, threshold, stage_outdir,
+                                                  cluster_mode, diameter, clique_budget, prune_nodes, workers),
+                                ClusteringConvergence(data_clean_path, patient_min, blosum, threshold, stage_outdir,
+                                                      cluster_mode, diameter, clique_budget, prune_nodes, workers)))
+        self.similar, self.convergence = self.stages[0]
+        self.reader = self.similar.reader
+        self.patient_min = patient_min
+        self.similarity_threshold = thresholds[0]
+        self.scheduler = Scheduler(workers)
+
+    def __cluster_helper__(self, group):
+        df = self.reader.load(group)
+        if patient_count(patient_set(df['patient_code'])) < self.patient_min:
+            return
+        codes, matrix = self.similar.__junctions__(df)
+        rows, cols, mismatches = similar_pairs(matrix, self.similarity_threshold)
+        convergent = self.convergence.__convergent__(matrix, rows, cols)
+        results = []
+        for similar, convergence in self.stages:
+            edges = mismatches <= max_mismatches(matrix.shape[1], similar.similarity_threshold)
+            results.append(similar.__cluster_edges__(df, codes, similar.__linked__(matrix), rows[edges], cols[edges]))
+            edges &= convergent
+            results.append(convergence.__cluster_edges__(df, codes, convergence.__linked__(matrix),
+                                                         rows[edges], cols[edges]))
+        return tuple(results)
+
+    def __component_helper__(self, component):
+        stage, component = component
+        return self.stages[stage // 2][stage % 2].__component_helper__(component)
+
+    def __compare__(self, stages):
+        """
+        write the number of clusters, clustered records and patients of every threshold to similarity_sweep.csv
+        """
+        total_patients = self.reader.read(['patient_code'])['patient_code'].nunique()
+        comparison = []
+        for stage in stages:
+            df = stage.store.read(['cluster_id', 'patient_code']) if stage.store.exists() else pd.DataFrame(
+                {'cluster_id': [], 'patient_code': []})
+            comparison.append({'similarity_threshold': stage.similarity_threshold,
+                               'clustering': stage.name,
+                               'clusters': df['cluster_id'].nunique(),
+                               'records': len(df),
+                               'patients': df['patient_code'].nunique(),
+                               'patient_coverage': df['patient_code'].nunique() / max(total_patients, 1)})
+        comparison = pd.DataFrame(comparison).round(5)
+        for _, i in comparison.iterrows():
+            logging.info(
+                f"Similarity {i['similarity_threshold']:g} {i['clustering']}: {i['clusters']:,d} clusters covering {i['patients']:,d} patients ({i['patient_coverage']:.1%})")
+        comparison.to_csv(self.outdir.joinpath("similarity_sweep.csv"), index=False)
+
+    def cluster(self):
+        """
+        Assign similar and convergence clusters for each records, returns the convergence clusters path
+        (of the lowest threshold in a sweep)
+        """
+        logging.info(
+            f"Clustering based on v_call, j_call and similar / convergence junction_aa fields in one pass ...")
+        groups = self.similar.__groups__()
+
+        logging.info(f"Assigning clusters ...")
+        results = self.scheduler.map(self.__cluster_helper__, groups,
+                                     [self.reader.size(i) ** 2 for i in groups])
+        results = [i for i in results if i is not None]
+        stages = [stage for pair in self.stages for stage in pair]
+        components = [(i, c) for result in results for i, (_, left) in enumerate(result) for c in left]
+        summaries = []
+        if components:
+            logging.info(
+                f"Assigning clusters of the large connected components of {len(components):,d} groups ...")
+            summaries = self.scheduler.map(self.__component_helper__, components,
+                                           [self.similar.__component_work__(c) for _, c in components])
+        for i, stage in enumerate(stages):
+            logging.info(f"{stage.name.upper()} JUNCTION-REGION CLUSTERING"
+                         + (f" (similarity {stage.similarity_threshold:g})" if self.sweep else ""))
+            stage.__write_summary__([result[i][0] for result in results] +
+                                    [s for (j, _), s in zip(components, summaries) if j == i])
+        if self.sweep:
+            self.__compare__(stages)
+        self.scheduler.report(self.outdir.joinpath("timings_combined.csv"))
+        return self.convergence.cluster_path
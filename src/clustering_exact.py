@@ -1,16 +1,20 @@
 import pandas as pd
 import logging
-from p_tqdm import p_map
+from group_reader import GroupReader, DERIVED_COLUMNS
+from cluster_store import ClusterStore
+from scheduler import Scheduler
 
 
 class ClusteringExact():
     """
     Clustering based on v_gene, j_gene and the exact match of junction_aa
+    The partitions of a partitioned table are clustered in parallel by workers processes (default: all CPUs)
     """
 
-    def __init__(self, data_clean_path, patient_min, outdir) -> None:
+    def __init__(self, data_clean_path, patient_min, outdir, workers=None) -> None:
         logging.info("EXACT JUNCTION-REGION CLUSTERING")
         self.data_clean_path = data_clean_path
+        self.reader = GroupReader(data_clean_path)
         self.patient_min = patient_min
 
         self.clustering_exact_path = outdir.joinpath(
@@ -18,56 +22,98 @@ class ClusteringExact():
         self.clustering_exact_path.mkdir(parents=True, exist_ok=True)
         self.cluster_path = self.clustering_exact_path.joinpath("clusters")
         self.cluster_path.mkdir(parents=True, exist_ok=True)
+        self.store = ClusterStore(self.clustering_exact_path)
+        self.workers = workers
 
-    def __cluster_helper__(self, df):
-        out = df.groupby(['v_call', 'j_call', 'junction_aa']).aggregate(
-            {"consensus_count": "mean", "patient_id": lambda x: "_".join(set(x))}).reset_index()
-        out['patient_count'] = out['patient_id'].str.count("_")+1
+    def __parameters__(self) -> dict:
+        """
+        parameters defining the clusters of the stage (see stage_cache.StageCache)
+        """
+        return {'stage': 'exact', 'patient_min': self.patient_min}
 
-        out_path = self.cluster_path.joinpath(
-            str(out['patient_count'].values[0]))
-        out_path.mkdir(parents=True, exist_ok=True)
+    def __exact__(self, df: pd.DataFrame) -> tuple:
+        """
+        Exact clusters of a table with one groupby: the records of the (v_call, j_call, junction_aa) groups having more than
+        one record and at least patient_min patients, numbered by cluster_id in the order of the groups, their summary
+        and the number of groups
+        """
+        grouped = df.groupby(['v_call', 'j_call', 'junction_aa'], observed=True)
+        cluster_id = grouped.ngroup()
+        patient_count = grouped['patient_code'].transform('nunique')
+        keep = (grouped['patient_code'].transform('size') > 1) & (
+            patient_count >= self.patient_min)
 
-        df.to_csv(out_path.joinpath(
-            f"{out['v_call'].values[0]}_{out['j_call'].values[0]}_{out['junction_aa'].values[0]}.csv"), index=False)
-        return out
+        records = df[keep].assign(cluster_id=cluster_id[keep].rank(method='dense').astype('int64') - 1,
+                                  patient_count=patient_count[keep])
+        records = records.sort_values(by=['cluster_id'], kind='stable')
+
+        clusters = records.groupby('cluster_id')
+        summary = clusters[['v_call', 'j_call', 'junction_aa', 'patient_count']].first()
+        summary['consensus_count'] = clusters['consensus_count'].mean()
+        summary['patient_id'] = records.drop_duplicates(['cluster_id', 'patient_code']).groupby(
+            'cluster_id')['patient_id'].agg("_".join)
+        return summary.reset_index(drop=True), records, grouped.ngroups
+
+    def __partition_helper__(self, group):
+        """
+        Exact clusters of one (v_call, j_call, junction_aa_length) partition
+        """
+        return self.__exact__(self.reader.load(group).drop(DERIVED_COLUMNS, axis=1, errors='ignore'))
 
     def cluster(self):
-        if not self.clustering_exact_path.joinpath("summary.csv").is_file() or True:
-            logging.info(
-                f"Clustering based on v_call, j_call and exact match of junction_aa ...")
-            df = pd.read_feather(self.data_clean_path)
-            total_patient = df['patient_id'].nunique()
+        """
+        Assign the exact clusters of the records
+        """
+        logging.info(
+            f"Clustering based on v_call, j_call and exact match of junction_aa ...")
+        if self.reader.partitioned:
+            total_patient = self.reader.read(['patient_id'])[
+                'patient_id'].nunique()
             logging.info(f"Number of patients: {total_patient:,d}")
+            # the partitions are read and clustered one at a time by the workers
+            logging.info(f"Assigning clusters ...")
+            groups = self.reader.groups()
+            results = Scheduler(self.workers).map(self.__partition_helper__, groups,
+                                                  [self.reader.size(i) for i in groups])
+            # number the clusters of the partitions one after the other
+            offset = 0
+            for _, records, _ in results:
+                count = records['cluster_id'].nunique()
+                records['cluster_id'] += offset
+                offset += count
+            summary = pd.concat([i for i, _, _ in results], ignore_index=True) if results else pd.DataFrame()
+            records = pd.concat([i for _, i, _ in results], ignore_index=True) if results else None
+            self.__write_summary__(summary, records)
+            return
 
-            logging.info(
-                f"Total clusters based on v_gene, j_gene and junction_aa: {(len(df.groupby(['v_call', 'j_call', 'junction_aa']))):,d}")
-
-            # cluster_patientid = df.groupby('cluster_exact')[
-            #     "patient_id"].count().reset_index().set_index('cluster_exact')
-            # cluster_patientid = cluster_patientid[cluster_patientid['patient_id']
-            #                                       >= self.patient_min]
-            # df_filtered = df[df['cluster_exact'].isin(cluster_patientid.index)]
+        df = pd.read_feather(self.data_clean_path)
+        total_patient = df['patient_id'].nunique()
+        logging.info(f"Number of patients: {total_patient:,d}")
 
-            groups = [i for _, i in df.groupby(['v_call', 'j_call', 'junction_aa']) if (
-                len(i) > 1) and (i['patient_id'].nunique() >= self.patient_min)]
-            logging.info(
-                f"Total clusters having minimum of {self.patient_min} members: {len(groups):,d}")
+        logging.info(f"Assigning clusters ...")
+        summary, records, total_clusters = self.__exact__(df)
+        logging.info(
+            f"Total clusters based on v_gene, j_gene and junction_aa: {total_clusters:,d}")
+        logging.info(
+            f"Total clusters having minimum of {self.patient_min} members: {len(summary):,d}")
+        self.__write_summary__(summary, records)
 
-            # write the clusters
-            logging.info(f"Assigning clusters ...")
-            summary_list = p_map(self.__cluster_helper__, groups)
-            summary = pd.concat(summary_list, ignore_index=True)
-            if not summary.empty:
-                logging.info(f"Writing summary file ...")
-                summary = summary.sort_values(
-                    by=['patient_count'], ascending=False)
-                summary = summary[['v_call', 'j_call', 'junction_aa',
-                                   'consensus_count', 'patient_count', 'patient_id']]
-                summary = summary.round(5)
-                summary.to_csv(self.clustering_exact_path.joinpath(
-                    "summary.csv"), index=False)
-            else:
-                logging.info("There's no exact VDJ cluster.")
+    def __write_summary__(self, summary: pd.DataFrame, records: pd.DataFrame):
+        """
+        write the clusters store and the summary file
+        """
+        self.store.write_records(records)
+        if not summary.empty:
+            logging.info(f"Writing summary file ...")
+            summary = summary.sort_values(
+                by=['patient_count'], ascending=False)
+            summary = summary[['v_call', 'j_call', 'junction_aa',
+                               'consensus_count', 'patient_count', 'patient_id']]
+            summary = summary.round(5)
+            summary.to_csv(self.clustering_exact_path.joinpath(
+                "summary.csv"), index=False)
+        else:
+            self.clustering_exact_path.joinpath("summary.csv").unlink(missing_ok=True)
+            logging.info("There's no exact VDJ cluster.")
         logging.info(f"Reports are at {self.clustering_exact_path}")
         logging.info(f"Finish clustering.\n")
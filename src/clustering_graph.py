@@ -0,0 +1,374 @@
+import numpy as np
+import pandas as pd
+import logging
+from collections import Counter
+
+from clique import clique_partition, component_partition, connected_components
+from patients import patient_set, patient_sets, patient_count
+from group_reader import GroupReader, DERIVED_COLUMNS
+from cluster_store import ClusterStore
+from scheduler import Scheduler
+
+
+class ClusteringGraph():
+    """
+    Shared steps of the similar and convergence clusterings of junction_aa of same v_call, j_call records and same length of junctions aa
+    For each group, the unique junctions are the nodes of a graph weighted by their number of records and the edges
+    are defined by the subclass (__edges__). The heaviest clique, i.e. the biggest clique of records, is recorded as a
+    cluster and removed from the graph until the graph is empty, ties between cliques of the same size are broken by
+    the order of the records (see clique.clique_partition). Clusters are expanded back to records when written
+    Before the partition, the connected components having less than patient_min patients are dropped, and with
+    prune_nodes the nodes that cannot be in a clique of patient_min patients too, which changes the clusters (see __prune__)
+    The graph is split into connected components, which are partitioned independently: components of one or two nodes
+    are clusters by themselves, and the components of at least large_component nodes of a group are searched together
+    as a separate task
+    With cluster_mode "component", the clusters are the connected components instead of cliques (single linkage),
+    split into balls of at most diameter edges if a diameter is given (see clique.component_partition)
+    The clique searches of a group are limited to clique_budget branch and bound steps in total, shared by its components
+    in turn (the large ones last): the nodes left when the budget is exceeded are covered by greedy cliques and the
+    component is reported in clustering_{name}/budget_report.csv
+    The groups and the large components are clustered in parallel by workers processes (default: all CPUs, see
+    scheduler.Scheduler)
+    The clusters are written together in clustering_{name}/clusters.feather (see cluster_store.ClusterStore)
+    """
+    name = None
+    large_component = 100
+    cluster_modes = ('clique', 'component')
+    clique_budget = 1_000_000
+
+    def __init__(self, data_clean_path, patient_min, similarity_threshold, outdir,
+                 cluster_mode='clique', diameter=None, clique_budget=None, prune_nodes=False, workers=None) -> None:
+        self.data_clean_path = data_clean_path
+        self.reader = GroupReader(data_clean_path)
+        self.patient_min = patient_min
+
+        self.clustering_path = outdir.joinpath(f"clustering_{self.name}")
+        self.clustering_path.mkdir(parents=True, exist_ok=True)
+        self.cluster_path = self.clustering_path.joinpath("clusters")
+        self.cluster_path.mkdir(parents=True, exist_ok=True)
+
+        self.similarity_threshold = similarity_threshold
+        self.scheduler = Scheduler(workers)
+        self.store = ClusterStore(self.clustering_path)
+        if cluster_mode not in self.cluster_modes:
+            raise ValueError(f"Unknown cluster mode {cluster_mode}, expected one of {', '.join(self.cluster_modes)}")
+        self.cluster_mode = cluster_mode
+        self.diameter = diameter
+        self.prune_nodes = prune_nodes
+        # 0 for no budget
+        if clique_budget is not None:
+            self.clique_budget = clique_budget or None
+
+    def __parameters__(self) -> dict:
+        """
+        parameters defining the clusters of the stage (see stage_cache.StageCache)
+        """
+        return {'stage': self.name, 'patient_min': self.patient_min, 'similarity_threshold': self.similarity_threshold,
+                'cluster_mode': self.cluster_mode, 'diameter': self.diameter, 'clique_budget': self.clique_budget,
+                'prune_nodes': self.prune_nodes}
+
+    def __edges__(self, matrix: np.ndarray):
+        """
+        (rows, cols) positions in the encoded matrix of the unique junctions linked by an edge
+        """
+        raise NotImplementedError
+
+    def __linked__(self, matrix: np.ndarray) -> np.ndarray:
+        """
+        True for the unique junctions whose records are linked to each other (the junction is linked to itself)
+        """
+        raise NotImplementedError
+
+    def __junctions__(self, df: pd.DataFrame) -> tuple:
+        """
+        unique junctions of a group in order of appearance: the junction of each record and the encoded matrix of the unique junctions
+        """
+        codes, _ = pd.factorize(df['junction_aa'])
+        return codes, self.reader.encode(df.iloc[np.unique(codes, return_index=True)[1]])
+
+    def __nodes__(self, codes: np.ndarray, linked: np.ndarray, rows: np.ndarray, cols: np.ndarray) -> tuple:
+        """
+        graph of the records of a group built from the graph of its unique junctions: a junction linked to itself is one
+        node weighted by its number of records, the records of another junction are nodes of weight 1 sharing its edges
+        returns the records (positions) of each node, the weights and the (rows, cols) edges of the nodes
+        """
+        records = np.argsort(codes, kind='stable')
+        counts = np.bincount(codes, minlength=len(linked))
+        starts = np.cumsum(counts) - counts
+        copies = np.where(linked, 1, counts)
+
+        # a node starts at each junction, and at each record of the junctions not linked to themselves
+        node_start = np.zeros(len(codes) + 1, dtype=bool)
+        node_start[starts] = True
+        node_start[np.flatnonzero(np.repeat(~linked, counts))] = True
+        node_start[-1] = True
+        offsets = np.flatnonzero(node_start)
+        first = np.searchsorted(offsets, starts)
+
+        # each junction edge links all the nodes of its two junctions
+        pairs = copies[rows] * copies[cols]
+        edge = np.repeat(np.arange(len(rows)), pairs)
+        within = np.arange(pairs.sum()) - np.repeat(np.cumsum(pairs) - pairs, pairs)
+        node_rows = first[rows][edge] + within // copies[cols][edge]
+        node_cols = first[cols][edge] + within % copies[cols][edge]
+
+        members = [records[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+        return members, np.diff(offsets), node_rows, node_cols
+
+    def __partition__(self, n: int, rows: np.ndarray, cols: np.ndarray, weights: np.ndarray, budget: int) -> tuple:
+        """
+        clusters of a connected component (lists of node positions) in the cluster mode, the fallback of the clique
+        search if it exceeded the budget left to its group (see clique.clique_partition), and the budget left after it
+        """
+        if self.cluster_mode == 'component':
+            return component_partition(n, rows, cols, weights, self.diameter), None, budget
+        clusters, fallback, steps = clique_partition(n, rows, cols, weights, budget)
+        return clusters, fallback, None if budget is None else max(budget - steps, 0)
+
+    def __fallback__(self, df: pd.DataFrame, n: int, rows: np.ndarray, weights: np.ndarray, fallback: dict) -> dict:
+        """
+        report of a component whose clique search exceeded the budget left to its group
+        """
+        first = df.iloc[0]
+        logging.warning(
+            f"Clique search budget exceeded in {first['v_call']} {first['j_call']} {first['junction_aa_length']}: "
+            f"{n:,d} nodes, {len(rows):,d} edges, {fallback['fallback_nodes']:,d} nodes left to the greedy cover")
+        return {'v_call': first['v_call'], 'j_call': first['j_call'], 'junction_aa_length': first['junction_aa_length'],
+                'nodes': n, 'records': int(np.sum(weights)), 'edges': len(rows),
+                'density': 2 * len(rows) / max(n * (n - 1), 1), 'budget': self.clique_budget, **fallback}
+
+    def __prune__(self, n: int, node: np.ndarray, codes: np.ndarray, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        """
+        True for the nodes kept for the partition, from the node and the patient code of each record.
+        The connected components having less than patient_min patients are dropped whole: no cluster crosses
+        components, so the clusters are unchanged.
+        With prune_nodes (clique mode only), the nodes whose closed neighbourhood (the node and its neighbours) has less
+        than patient_min patients are also dropped, and again among the nodes left until none is dropped. They can't be
+        in a clique of patient_min patients, but the partition takes the heaviest clique first whatever its patients,
+        so dropping them changes the cliques found and the clusters (e.g. a triangle of one patient is no longer taken
+        before the pair of patients it overlaps)
+        """
+        # distinct (node, patient) pairs, sorted by node
+        width = int(codes.max()) + 1 if len(codes) else 1
+        pairs = np.unique(node * width + codes)
+        pair_nodes, pair_codes = pairs // width, pairs % width
+
+        labels = connected_components(n, rows, cols)
+        component_patients = np.bincount(np.unique(labels[pair_nodes] * width + pair_codes) // width, minlength=n)
+        keep = component_patients[labels] >= self.patient_min
+        if not self.prune_nodes or self.cluster_mode != 'clique':
+            return keep
+
+        counts = np.bincount(pair_nodes, minlength=n)
+        starts = np.cumsum(counts) - counts
+        # the nodes having enough patients by themselves are never dropped
+        at_risk = keep & (counts < self.patient_min)
+        check = at_risk
+        rows, cols = np.concatenate([rows, cols]), np.concatenate([cols, rows])
+        while check.any():
+            # the patients of the closed neighbourhood of the checked nodes: their own and those of their neighbours
+            live = check[rows] & keep[cols]
+            u, v = rows[live], cols[live]
+            repeats = counts[v]
+            positions = np.repeat(starts[v] - np.cumsum(repeats) + repeats, repeats) + np.arange(repeats.sum())
+            own = check[pair_nodes]
+            reach = np.unique(np.concatenate([pair_nodes[own], np.repeat(u, repeats)]) * width +
+                              np.concatenate([pair_codes[own], pair_codes[positions]]))
+            drop = check & (np.bincount(reach // width, minlength=n) < self.patient_min)
+            if not drop.any():
+                break
+            keep &= ~drop
+            # only the neighbours of the dropped nodes can lose patients
+            neighbours = np.zeros(n, dtype=bool)
+            neighbours[rows[drop[cols]]] = True
+            check = at_risk & keep & neighbours
+        return keep
+
+    def __cluster_edges__(self, df: pd.DataFrame, codes, linked, rows, cols):
+        """
+        Assign cluster for each records of a group from the edges of its unique junctions using clique finding algorithm,
+        one value can be assigned to one cluster. Returns the clusters (see __cluster_records__), and the large components
+        left to __component_helper__ with the budget left by the others (an empty list if there is none)
+        """
+        members, weights, rows, cols = self.__nodes__(codes, linked, rows, cols)
+        node = np.empty(len(df), dtype=np.int64)
+        node[np.concatenate(members)] = np.repeat(np.arange(len(members)), weights)
+        patient_codes = df['patient_code'].to_numpy(np.int64)
+        patients = patient_sets(patient_codes, node, len(members))
+        kept = np.flatnonzero(self.__prune__(len(members), node, patient_codes, rows, cols))
+        live = np.zeros(len(members), dtype=bool)
+        live[kept] = True
+        live = live[rows] & live[cols]
+        rows, cols = rows[live], cols[live]
+        labels = connected_components(len(members), rows, cols)
+        nodes = kept[np.argsort(labels[kept], kind='stable')]
+        components, starts = np.unique(labels[nodes], return_index=True)
+        ends = np.append(starts[1:], len(nodes))
+        edges = np.argsort(labels[rows], kind='stable')
+        edge_bounds = np.searchsorted(labels[rows][edges], np.append(components, len(members)))
+
+        clusters, components_left, fallbacks = [], [], []
+        budget = self.clique_budget
+        for i in range(len(components)):
+            component = nodes[starts[i]:ends[i]]
+            if len(component) == 1:
+                if weights[component[0]] > 1:
+                    clusters.append(component)
+                continue
+            if len(component) == 2 and self.cluster_mode == 'clique':
+                clusters.append(component)
+                continue
+            component_edges = edges[edge_bounds[i]:edge_bounds[i + 1]]
+            component_rows = np.searchsorted(component, rows[component_edges])
+            component_cols = np.searchsorted(component, cols[component_edges])
+            if len(component) >= self.large_component and self.cluster_mode == 'clique':
+                records = np.sort(np.concatenate([members[j] for j in component]))
+                components_left.append((df.iloc[records],
+                                        [np.searchsorted(records, members[j]) for j in component],
+                                        weights[component], [patients[j] for j in component],
+                                        component_rows, component_cols))
+                continue
+            partition, fallback, budget = self.__partition__(
+                len(component), component_rows, component_cols, weights[component], budget)
+            clusters.extend(component[c] for c in partition)
+            if fallback is not None:
+                fallbacks.append(self.__fallback__(
+                    df, len(component), component_rows, weights[component], fallback))
+
+        return (*self.__cluster_records__(df, members, patients, clusters), fallbacks), \
+            [(components_left, budget)] if components_left else []
+
+    @staticmethod
+    def __component_work__(components) -> int:
+        """
+        estimated work of the large components of a group, quadratic in their number of nodes
+        """
+        return sum(len(component[1]) ** 2 for component in components[0])
+
+    def __component_helper__(self, components):
+        """
+        clusters of the large connected components of a group, searched in turn with the budget left by the group
+        """
+        components, budget = components
+        summaries, records, fallbacks = [], [], []
+        for df, members, weights, patients, rows, cols in components:
+            clusters, fallback, budget = self.__partition__(len(members), rows, cols, weights, budget)
+            if fallback is not None:
+                fallbacks.append(self.__fallback__(df, len(members), rows, weights, fallback))
+            summary, component_records = self.__cluster_records__(df, members, patients, clusters)
+            if summary is not None:
+                summaries.append(summary)
+            records.extend(component_records)
+        return (pd.concat(summaries, ignore_index=True) if summaries else None), records, fallbacks
+
+    def __cluster_records__(self, df: pd.DataFrame, members: list, patients: list, clusters: list):
+        """
+        clusters (lists of nodes, whose records and patient sets are members and patients) having at least patient_min
+        patients: their summary and the list of their records with the patient_count.
+        The patients of a cluster are the union of the patient sets of its nodes
+        """
+        summary, records = [], []
+        for c in clusters:
+            patient_uniq = 0
+            for j in c:
+                patient_uniq |= patients[j]
+            patient_uniq = patient_count(patient_uniq)
+            if patient_uniq >= self.patient_min:
+                df_out = df.iloc[np.sort(np.concatenate([members[j] for j in c]))].drop(
+                    DERIVED_COLUMNS, axis=1, errors='ignore')
+                records.append(df_out.assign(patient_count=patient_uniq))
+                summary.append({'v_call': df_out['v_call'].iloc[0],
+                                'j_call': df_out['j_call'].iloc[0],
+                                'consensus_count': df_out['consensus_count'].mean(),
+                                'patient_id': "_".join(df_out['patient_id'].unique()),
+                                'junction_aa': Counter(df_out['junction_aa']).most_common()[0][0],
+                                'patient_count': patient_uniq})
+
+        return (pd.DataFrame(summary) if summary else None), records
+
+    def __cluster_helper__(self, group):
+        df = self.reader.load(group)
+        if patient_count(patient_set(df['patient_code'])) < self.patient_min:
+            return
+        codes, matrix = self.__junctions__(df)
+        rows, cols = self.__edges__(matrix)
+        return self.__cluster_edges__(df, codes, self.__linked__(matrix), rows, cols)
+
+    def __assign__(self, groups):
+        """
+        clusters of the groups, then of the large components they left
+        the work of a group is estimated as quadratic in its number of records (see __component_work__ for the components)
+        """
+        results = self.scheduler.map(self.__cluster_helper__, groups,
+                                     [self.reader.size(i) ** 2 for i in groups])
+        results = [i for i in results if i is not None]
+        cluster_list = [clusters for clusters, _ in results]
+        components = [c for _, left in results for c in left]
+        if components:
+            logging.info(
+                f"Assigning clusters of the large connected components of {len(components):,d} groups ...")
+            cluster_list += self.scheduler.map(self.__component_helper__, components,
+                                               [self.__component_work__(c) for c in components])
+        self.scheduler.report(self.clustering_path.joinpath("timings.csv"))
+        return cluster_list
+
+    def __write_fallbacks__(self, fallbacks: list) -> None:
+        """
+        write the components whose clique search exceeded the budget to budget_report.csv
+        """
+        report_path = self.clustering_path.joinpath("budget_report.csv")
+        if not fallbacks:
+            report_path.unlink(missing_ok=True)
+            return
+        report = pd.DataFrame(fallbacks).sort_values(by=['nodes'], ascending=False).round(5)
+        logging.warning(
+            f"{len(report):,d} components exceeded the clique search budget of {self.clique_budget:,d} steps, "
+            f"{report['fallback_clusters'].sum():,d} clusters were found by the greedy fallback. See {report_path}")
+        report.to_csv(report_path, index=False)
+
+    def __write_summary__(self, cluster_list):
+        """
+        write the clusters store, the budget report and the summary file from the (summary, records, fallbacks) of the tasks
+        """
+        self.__write_fallbacks__([i for _, _, fallbacks in cluster_list for i in fallbacks])
+        total_clusters = self.store.write(
+            [i for _, records, _ in cluster_list for i in records])
+        logging.info(
+            f"Total clusters based on v_gene, j_gene and {self.name} junction_aa: {total_clusters:,d}")
+
+        # generate summary file
+        logging.info("Writing summary file ...")
+        summary_list = [i for i, _, _ in cluster_list if i is not None]
+        if len(summary_list) != 0:
+            summary = pd.concat(summary_list, ignore_index=True)
+            summary = summary.sort_values(
+                by=['patient_count'], ascending=False)
+            summary = summary.round(5)
+            summary = summary[['v_call', 'j_call', 'junction_aa',
+                               'consensus_count', 'patient_count', 'patient_id']]
+            summary.to_csv(self.clustering_path.joinpath(
+                "summary.csv"), index=False)
+        else:
+            self.clustering_path.joinpath("summary.csv").unlink(missing_ok=True)
+            logging.info(f"There's no {self.name} VDJ cluster.")
+        logging.info(f"Reports are at {self.clustering_path}")
+        logging.info(f"Finish clustering.\n")
+
+    def __groups__(self):
+        groups = self.reader.groups(self.patient_min)
+        logging.info(
+            f"Total clusters based on v_gene, j_gene and length of junction_aa: {len(groups):,d}")
+        return groups
+
+    def cluster(self):
+        """
+        Assign cluster for each records based on the edges of the subclass
+        """
+        logging.info(
+            f"Clustering based on v_call, j_call and {self.name} junction_aa fields ...")
+        groups = self.__groups__()
+
+        # write clusters using multi-processing with tqdm wrapper
+        logging.info(f"Assigning clusters ...")
+        self.__write_summary__(self.__assign__(groups))
+        return self.cluster_path
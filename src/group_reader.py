@@ -0,0 +1,162 @@
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.feather
+import pyarrow.parquet as pq
+from preprocessing import AGGREGATED_SCHEMA
+from sequence_store import SequenceStore, encode_junctions
+
+GROUP_KEYS = ['v_call', 'j_call', 'junction_aa_length']
+# columns added to the groups by the reader, not written to the outputs
+DERIVED_COLUMNS = ['junction_aa_length', 'junction_row']
+
+
+def format_sample_index(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    copy of df with the sample_index lists written as "_" joined values, as in data_clean.csv
+    """
+    df = df.copy()
+    df['sample_index'] = df['sample_index'].map(
+        lambda x: "_".join(map(str, x)))
+    return df
+
+
+class GroupReader():
+    """
+    Split a cleaned chain table into (v_call, j_call, junction_aa_length) groups
+    data_clean_path is either data_clean.feather or the hive partitioned parquet dataset written by PreProcessing
+    (each partition is one group and is only read by the worker loading it).
+    data_clean.feather is copied once, sorted by group, to the uncompressed arrow file data_clean_groups.arrow, and a group
+    is its (offset, length) row range: the workers memory-map the file and only the row ranges are sent to them.
+    store is the SequenceStore written next to it, if any: data_clean_groups.arrow then also has the junction_row column,
+    the row of the junction of each record in the store matrix of its length, so encode() gathers the encoded junctions
+    of a group without looking their strings up
+    """
+
+    def __init__(self, data_clean_path: Path) -> None:
+        self.data_clean_path = Path(data_clean_path)
+        self.partitioned = self.data_clean_path.is_dir()
+        self.columns = AGGREGATED_SCHEMA.names + ['junction_aa_length']
+        store_path = self.data_clean_path.parent.joinpath("junction_store")
+        self.store = SequenceStore(store_path) if store_path.is_dir() else None
+        self.groups_path = self.data_clean_path.with_name(
+            self.data_clean_path.stem + "_groups.arrow")
+        self.table = None
+
+    def __getstate__(self):
+        # the memory-mapped table is re-opened by each process instead of being pickled
+        state = self.__dict__.copy()
+        state['table'] = None
+        return state
+
+    def __source__(self) -> dict:
+        """
+        size and mtime (ns) of data_clean and of the junction store, recorded in the schema metadata of
+        data_clean_groups.arrow: the file is only reused if they are the same
+        """
+        stat = self.data_clean_path.stat()
+        source = {b'data_clean': f"{stat.st_size} {stat.st_mtime_ns}".encode()}
+        if self.store is not None:
+            source[b'junction_store'] = " ".join(f"{f.name} {f.stat().st_size} {f.stat().st_mtime_ns}" for f in sorted(
+                self.store.store_path.glob("length_*.npy"))).encode()
+        return source
+
+    def __sort__(self) -> None:
+        """
+        write data_clean sorted by group (stable, so the records keep their order within a group) with junction_aa_length
+        and junction_row if there is a store, unless data_clean_groups.arrow was written from the same data_clean and store
+        """
+        source = self.__source__()
+        if self.groups_path.is_file() and \
+                pa.ipc.open_file(pa.memory_map(str(self.groups_path))).schema.metadata == source:
+            return
+        table = pyarrow.feather.read_table(self.data_clean_path)
+        table = table.append_column('junction_aa_length', pc.utf8_length(
+            table['junction_aa']).cast(pa.int64()))
+        table = table.sort_by([(c, 'ascending') for c in GROUP_KEYS])
+        if self.store is not None:
+            lengths = table['junction_aa_length'].to_numpy()
+            junctions = table['junction_aa'].to_numpy(zero_copy_only=False)
+            junction_row = np.empty(len(table), dtype=np.int32)
+            for length in np.unique(lengths):
+                records = np.flatnonzero(lengths == length)
+                junction_row[records] = self.store.rows(junctions[records], int(length))
+            table = table.append_column('junction_row', pa.array(junction_row))
+        table = table.replace_schema_metadata(source)
+        temp_path = self.groups_path.with_name(self.groups_path.name + ".tmp")
+        with pa.ipc.new_file(temp_path, table.schema) as writer:
+            writer.write_table(table)
+        temp_path.replace(self.groups_path)
+
+    def __table__(self) -> pa.Table:
+        """
+        memory-mapped data_clean_groups.arrow, opened once per process
+        """
+        if self.table is None:
+            self.table = pa.ipc.open_file(
+                pa.memory_map(str(self.groups_path))).read_all()
+        return self.table
+
+    def read(self, columns: list = None) -> pd.DataFrame:
+        """
+        read the whole table (or only some columns)
+        """
+        if self.partitioned:
+            return ds.dataset(self.data_clean_path, format='parquet', partitioning='hive').to_table(columns=columns).to_pandas()
+        df = pd.read_feather(self.data_clean_path, columns=columns)
+        if columns is None or 'junction_aa_length' in columns:
+            df['junction_aa_length'] = df['junction_aa'].str.len()
+        return df
+
+    def groups(self, patient_min: int = 1) -> list:
+        """
+        list of group handles to be passed to load()
+        row ranges of groups having less than patient_min patients are dropped here, the partitions by the caller
+        """
+        if self.partitioned:
+            partitions = {}
+            for fragment in ds.dataset(self.data_clean_path, format='parquet', partitioning='hive').get_fragments():
+                partitions.setdefault(
+                    Path(fragment.path).parent, []).append(fragment.path)
+            return list(partitions.values())
+        self.__sort__()
+        keys = self.__table__().select(GROUP_KEYS + ['patient_code']).to_pandas()
+        grouped = keys.groupby(GROUP_KEYS, sort=False)
+        lengths = grouped.size().to_numpy()
+        offsets = np.cumsum(lengths) - lengths
+        patients = grouped['patient_code'].nunique().to_numpy()
+        return [(int(offset), int(length)) for offset, length, patient in zip(offsets, lengths, patients)
+                if patient >= patient_min]
+
+    def size(self, group) -> int:
+        """
+        number of records of a group handle, from the parquet metadata for the partitioned ones
+        """
+        if not self.partitioned:
+            return group[1]
+        return sum(pq.read_metadata(f).num_rows for f in group)
+
+    def load(self, group) -> pd.DataFrame:
+        """
+        dataframe of a group handle
+        """
+        if not self.partitioned:
+            offset, length = group
+            df = self.__table__().slice(offset, length).to_pandas()
+            df.index = pd.RangeIndex(offset, offset + length)
+            return df
+        df = ds.dataset(group, format='parquet', partitioning=ds.HivePartitioning.discover(),
+                        partition_base_dir=str(self.data_clean_path)).to_table().to_pandas()
+        return df[[c for c in self.columns if c in df.columns]]
+
+    def encode(self, df: pd.DataFrame) -> np.ndarray:
+        """
+        encoded junction_aa matrix of a group, gathered from the junction store by junction_row if any
+        """
+        length = int(df['junction_aa_length'].iloc[0])
+        if 'junction_row' in df:
+            return self.store.matrix(length)[df['junction_row'].to_numpy()]
+        return encode_junctions(df['junction_aa'], length)
@@ -10,6 +10,7 @@ from sklearn.cluster import DBSCAN
 from plotly.subplots import make_subplots
 import plotly.graph_objects as go
 import random
+from cluster_store import ClusterStore, cluster_name
 
 
 class LightChainAnalysis():
@@ -120,10 +121,13 @@ class LightChainAnalysis():
         # p_map(self.__cluster_helper__, groups)
         results = pd.DataFrame(
             columns=['score', 'correlation', 'distance', 'light', 'heavy', 'patient_count'])
-        for f in tqdm(self.group_cluster_path.glob("**/*.csv"), total=len(list(self.group_cluster_path.glob("**/*.csv")))):
-            heavy_cluster = pd.read_csv(f)
+        store = ClusterStore(self.group_cluster_path.parent)
+        for _, patient_count, heavy_cluster in tqdm(store.clusters(), total=store.read(['cluster_id'])['cluster_id'].nunique()):
             heavy_cluster = heavy_cluster.astype({"patient_id": str})
-            heavy_chain = f.stem
+            heavy_chain = cluster_name(heavy_cluster)
+            # path of the cluster csv, the light chain reports are written next to its light counterpart
+            f = self.group_cluster_path.joinpath(
+                str(patient_count), heavy_chain + ".csv")
 
             heavy_expression = pd.DataFrame(heavy_cluster.value_counts(
                 ['patient_id']).sort_index(), columns=['cluster_expression'])
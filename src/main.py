@@ -1,4 +1,5 @@
 import argparse
+import logging
 from pathlib import Path
 from myLog import Log
 from preprocessing import PreProcessing
@@ -7,7 +8,32 @@ import time
 from clustering_exact import ClusteringExact
 from clustering_similar import ClusteringSimilar
 from clustering_convergence import ClusteringConvergence
+from clustering_combined import ClusteringCombined
 from light_chain import LightChainAnalysis
+from stage_cache import StageCache, file_digest
+
+
+def run_stage(stage, outputs: list, data_digest: str, force: bool = False, export_csv: bool = False) -> None:
+    """
+    run a clustering stage unless the fingerprints of all its outputs (directory, clustering) match their inputs:
+    the heavy chain data content, the parameters of the clustering and the code version
+    with export_csv, the clusters of every output are then exported as csv files, whether the stage ran or not
+    """
+    caches = [StageCache(path, {'data_clean': data_digest, **clustering.__parameters__()})
+              for path, clustering in outputs]
+    if not force and all(i.valid() for i in caches):
+        for path, _ in outputs:
+            logging.info(f"Skipping, the inputs are unchanged since the clusters at {path}")
+    else:
+        for i in caches:
+            i.invalidate()
+        stage.cluster()
+        for i in caches:
+            i.record()
+    if export_csv:
+        for _, clustering in outputs:
+            logging.info(f"Exporting clusters to {clustering.cluster_path} ...")
+            clustering.store.export_csv(clustering.cluster_path)
 
 
 def main(args):
@@ -23,7 +49,18 @@ def main(args):
       -g manifest.txt path (MUST HAVE sample_id and patient_id column)
       -o output directory path
       -l (Optional) log path
-      -f (Optional) force to re-run
+      -f (Optional) force to re-run the clustering stages, which are otherwise skipped if the fingerprint of their
+        inputs (heavy chain data content, parameters, BLOSUM table and code version) is unchanged
+      -b, -m (Optional) batch size (samples) and memory ceiling (GB) of the streaming preprocessing
+      -w (Optional) worker processes of the preprocessing and clustering stages
+      --cluster_csv (Optional) export one csv file per cluster besides the clusters.feather store, even if the stage is skipped
+      -s (Optional) similarity threshold, several thresholds (-s 0.7,0.8 or -s 0.7 -s 0.8) run a sweep of the similar and
+        convergence clusterings
+      --cluster_mode (Optional) clique (default) or component clusters of the similar and convergence graphs,
+        --diameter (Optional) caps the number of edges between two junctions of a component cluster
+      --prune_nodes (Optional) drop the nodes that cannot be in a clique of patient_min patients before the clique search
+        (faster, but the clusters differ from the full partition)
+      --clique_budget (Optional) branch and bound steps of the clique searches of a group before the greedy fallback
     """
     start = time.time()
 
@@ -56,8 +93,14 @@ def main(args):
     logging.info(f"Amino acid score table path is {aa_group_path}")
     logging.info(f"GDC metadata path is {gdc_path}")
     logging.info(f"Log path is {log_path}")
-    logging.info(f"Similarity threshold: {args.similarity}")
+    logging.info(
+        f"Similarity threshold: {', '.join(f'{i:g}' for i in args.similarity)}")
     logging.info(f"Minimum number of patient in a cluster: {args.patient_min}")
+    logging.info(
+        f"Cluster mode: {args.cluster_mode}" + (f", diameter {args.diameter}" if args.diameter else "")
+        + (", nodes pruned before the clique search" if args.prune_nodes else ""))
+    logging.info(
+        f"Preprocessing batch: {args.batch_size or 'all'} samples, {args.memory_limit or 'unlimited'} GB")
     logging.info(
         f"Output directory is {outdir_path}\n")
 
@@ -65,16 +108,38 @@ def main(args):
 
     try:
         data_heavy_clean_path, data_light_clean_path = PreProcessing(
-            indir_path, gdc_path, (outdir_heavy_path, outdir_light_path)).concatenate_airr()
+            indir_path, gdc_path, (outdir_heavy_path, outdir_light_path),
+            batch_size=args.batch_size, memory_limit=args.memory_limit, partition=args.partition,
+            workers=args.workers, io_threads=args.io_threads,
+            inventory_path=Path(args.inventory) if args.inventory else None).concatenate_airr()
 
         # heavy chain analysis
         logging.info("HEAVY CHAIN ANALYSIS")
-        ClusteringExact(data_heavy_clean_path, args.patient_min,
-                        outdir_heavy_path).cluster()
-        ClusteringSimilar(
-            data_heavy_clean_path, args.patient_min, args.similarity, outdir_heavy_path).cluster()
-        group_cluster_path = ClusteringConvergence(data_heavy_clean_path, args.patient_min, aa_group_path, args.similarity,
-                                                   outdir_heavy_path).cluster()
+        data_digest = file_digest(data_heavy_clean_path)
+        logging.info(f"Heavy chain data fingerprint: {data_digest}")
+
+        exact = ClusteringExact(data_heavy_clean_path, args.patient_min, outdir_heavy_path, args.workers)
+        run_stage(exact, [(exact.clustering_exact_path, exact)], data_digest, args.force, args.cluster_csv)
+        if len(args.similarity) > 1 or args.combined:
+            # sweep: the similarities of each group are computed once for all the thresholds
+            combined = ClusteringCombined(data_heavy_clean_path, args.patient_min, aa_group_path,
+                                          args.similarity if len(args.similarity) > 1 else args.similarity[0],
+                                          outdir_heavy_path, args.cluster_mode, args.diameter, args.clique_budget,
+                                          args.prune_nodes, args.workers)
+            run_stage(combined, [(stage.clustering_path, stage) for pair in combined.stages for stage in pair],
+                      data_digest, args.force, args.cluster_csv)
+            group_cluster_path = combined.convergence.cluster_path
+        else:
+            similar = ClusteringSimilar(
+                data_heavy_clean_path, args.patient_min, args.similarity[0], outdir_heavy_path,
+                args.cluster_mode, args.diameter, args.clique_budget, args.prune_nodes, args.workers)
+            run_stage(similar, [(similar.clustering_path, similar)], data_digest, args.force, args.cluster_csv)
+            convergence = ClusteringConvergence(data_heavy_clean_path, args.patient_min, aa_group_path, args.similarity[0],
+                                                outdir_heavy_path, args.cluster_mode, args.diameter, args.clique_budget,
+                                                args.prune_nodes, args.workers)
+            run_stage(convergence, [(convergence.clustering_path, convergence)], data_digest, args.force,
+                      args.cluster_csv)
+            group_cluster_path = convergence.cluster_path
 
         # # light chain analysis
         # logging.info("LIGHT CHAIN ANALYSIS")
@@ -90,6 +155,13 @@ def main(args):
         f"Total running time: {str(timedelta(seconds=running_time))}\n")
 
 
+def thresholds(value: str) -> list:
+    """
+    similarity thresholds of a comma separated -s value
+    """
+    return [float(i) for i in value.split(",") if i]
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description='CDR3 analysis')
@@ -117,8 +189,49 @@ if __name__ == "__main__":
                         default=2,
                         help='Minimum number of patient in a cluster')
     parser.add_argument('-s', '--similarity',
+                        type=thresholds,
+                        action='extend',
+                        help='CD-HIT similarity threshold (default: 0.8). Several thresholds, comma separated or repeated (-s 0.7,0.8 or -s 0.7 -s 0.8), run a sweep writing each one to heavy/similarity_{threshold} and comparing them in heavy/similarity_sweep.csv')
+    parser.add_argument('-f', '--force',
+                        action='store_true',
+                        help='Re-run the clustering stages even if the fingerprint of their inputs is unchanged')
+    parser.add_argument('--combined',
+                        action='store_true',
+                        help='Run similar and convergence clustering in one pass sharing the similarity graph')
+    parser.add_argument('--cluster_csv',
+                        action='store_true',
+                        help='Also export each cluster as its own csv file (clusters/{patient_count}/{v}_{j}_{junction}.csv)')
+    parser.add_argument('--cluster_mode', '--cluster-mode',
+                        choices=['clique', 'component'],
+                        default='clique',
+                        help='Clusters of the similar and convergence graphs: cliques (default), or connected components (single linkage, near linear time)')
+    parser.add_argument('--diameter',
+                        type=int,
+                        help='With --cluster_mode component, maximum number of edges between two junctions of a cluster (components are split into balls of radius diameter // 2)')
+    parser.add_argument('--prune_nodes',
+                        action='store_true',
+                        help='Drop the nodes whose neighbourhood has less than patient_min patients before the clique search. Faster on groups of private clonotypes, but the clusters change: the heaviest cliques are taken among the nodes left only')
+    parser.add_argument('--clique_budget',
+                        type=int,
+                        help='Branch and bound steps of the clique searches of a (v_call, j_call, junction_aa_length) group, shared by its connected components (default: 1,000,000, 0 for no budget). Past it, the rest of the group is covered by greedy cliques and reported in budget_report.csv')
+    parser.add_argument('-b', '--batch_size',
+                        type=int,
+                        help='Maximum number of samples read at once in preprocessing')
+    parser.add_argument('-m', '--memory_limit',
                         type=float,
-                        default=0.8,
-                        help='CD-HIT similarity threshold')
+                        help='Memory ceiling (GB) of a preprocessing batch')
+    parser.add_argument('--partition',
+                        action='store_true',
+                        help='Write the cleaned chains as parquet datasets partitioned by v_call, j_call and junction_aa length')
+    parser.add_argument('-w', '--workers',
+                        type=int,
+                        help='Number of worker processes parsing the _airr.tsv files and running the clustering stages (default: all CPUs)')
+    parser.add_argument('--io_threads',
+                        type=int,
+                        help='Number of read-ahead/decompression threads of each parsing process')
+    parser.add_argument('--inventory',
+                        type=str,
+                        help='Cached list of the _airr.tsv files, written after scanning the input directory and read instead of scanning if it exists. Its files are checked again and the directories modified since are rescanned')
     args = parser.parse_args()
+    args.similarity = args.similarity or [0.8]
     main(args)
@@ -0,0 +1,47 @@
+import numpy as np
+
+
+def patient_set(codes) -> int:
+    """
+    set of patient codes as a python integer used as a bitset: bit c is set if patient c is in the set
+    """
+    codes = np.unique(np.asarray(codes, dtype=np.int64))
+    if len(codes) == 0:
+        return 0
+    bits = np.zeros(codes[-1] // 8 + 1, dtype=np.uint8)
+    np.bitwise_or.at(bits, codes >> 3, np.left_shift(1, codes & 7).astype(np.uint8))
+    return int.from_bytes(bits.tobytes(), 'little')
+
+
+def patient_sets(codes, groups, n_groups: int) -> list:
+    """
+    patient set of each group of records (groups[i] is the group of the record of patient codes[i])
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    groups = np.asarray(groups, dtype=np.int64)
+    order = np.lexsort((codes, groups))
+    bounds = np.searchsorted(groups[order], np.arange(n_groups + 1))
+    codes = codes[order]
+    return [patient_set(codes[bounds[i]:bounds[i + 1]]) for i in range(n_groups)]
+
+
+def patient_count(patients: int) -> int:
+    """
+    number of patients of a set (popcount)
+    """
+    return patients.bit_count()
+
+
+def patient_codes(patients: int) -> np.ndarray:
+    """
+    sorted patient codes of a set
+    """
+    bits = np.frombuffer(patients.to_bytes((patients.bit_length() + 7) // 8, 'little'), dtype=np.uint8)
+    return np.flatnonzero(np.unpackbits(bits, bitorder='little'))
+
+
+def patient_overlap(a: int, b: int) -> int:
+    """
+    number of patients shared by two sets
+    """
+    return (a & b).bit_count()
@@ -1,7 +1,18 @@
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv
+import pyarrow.dataset as ds
+import pyarrow.ipc
+import os
+import shutil
+import time
 from pathlib import Path
 import logging
 from p_tqdm import p_map
+from pandas.api.types import union_categoricals
+from sequence_store import SequenceStore
 
 counter = 0  # initial value
 
@@ -12,17 +23,191 @@ def func(row):
     return counter
 
 
+# the only _airr.tsv columns used by the pipeline
+AIRR_TYPES = {'v_call': pa.dictionary(pa.int32(), pa.string()),
+              'j_call': pa.dictionary(pa.int32(), pa.string()),
+              'c_call': pa.dictionary(pa.int32(), pa.string()),
+              'junction_aa': pa.string(),
+              'consensus_count': pa.int64()}
+
+# compression of the _airr.tsv files by suffix, and their estimated compression ratio
+AIRR_COMPRESSION = {'_airr.tsv': None,
+                    '_airr.tsv.gz': 'gzip',
+                    '_airr.tsv.bgz': 'gzip',
+                    '_airr.tsv.zst': 'zstd'}
+AIRR_COMPRESSION_RATIO = {'_airr.tsv.gz': 5,
+                          '_airr.tsv.bgz': 5,
+                          '_airr.tsv.zst': 6}
+
+AGGREGATION_KEYS = ['sample_id', 'v_call', 'j_call',
+                    'junction_aa', 'patient_id', 'IG_subtypes']
+
+# chain categories: IGH, IGK or IGL, anything else
+HEAVY, LIGHT, OTHERS = 0, 1, 2
+
+CATEGORICAL_COLUMNS = ['sample_id', 'v_call',
+                       'j_call', 'IG_subtypes', 'patient_id']
+
+# one partition per (v_call, j_call, junction_aa_length) group
+PARQUET_MAX_PARTITIONS = 1_000_000
+
+MANIFEST_COLUMNS = ['sample_id', 'path', 'size', 'mtime', 'patient_id']
+
+PATIENT_COLUMNS = ['patient_id', 'patient_code']
+
+AGGREGATED_SCHEMA = pa.schema([('sample_id', pa.string()),
+                               ('v_call', pa.string()),
+                               ('j_call', pa.string()),
+                               ('junction_aa', pa.string()),
+                               ('patient_id', pa.string()),
+                               ('patient_code', pa.int32()),
+                               ('IG_subtypes', pa.string()),
+                               ('consensus_count', pa.int64()),
+                               ('sample_index', pa.list_(pa.int64()))])
+
+RECORD_SCHEMA = pa.schema([('sample_id', pa.string()),
+                           ('sample_index', pa.int64()),
+                           ('v_call', pa.string()),
+                           ('j_call', pa.string()),
+                           ('junction_aa', pa.string()),
+                           ('IG_subtypes', pa.string()),
+                           ('consensus_count', pa.int64()),
+                           ('patient_id', pa.string()),
+                           ('patient_code', pa.int32())])
+
+
+def map_dictionary(column: pa.ChunkedArray, func, **kwargs) -> pa.ChunkedArray:
+    """
+    apply a string kernel on the dictionary of each chunk instead of every value, then re-encode the
+    dictionary since the mapped values may collide (e.g. IGHV3-23*01 and IGHV3-23*04)
+    """
+    chunks = []
+    for chunk in column.chunks:
+        mapped = pc.dictionary_encode(func(chunk.dictionary, **kwargs))
+        chunks.append(pa.DictionaryArray.from_arrays(
+            pc.take(mapped.indices, chunk.indices), mapped.dictionary))
+    return pa.chunked_array(chunks, type=column.type)
+
+
+def concat_categorical(df_list: list) -> pd.DataFrame:
+    """
+    concatenate dataframes while keeping the categorical columns categorical (union of the categories)
+    """
+    for c in CATEGORICAL_COLUMNS:
+        categories = union_categoricals(
+            [df[c] for df in df_list], ignore_order=True).categories.sort_values()
+        for df in df_list:
+            df[c] = df[c].cat.set_categories(categories)
+    return pd.concat(df_list, ignore_index=True)
+
+
+def airr_suffix(filename: Path) -> str:
+    return filename.name[filename.name.rfind("_airr.tsv"):]
+
+
+def classify_chain(v_call: pd.Series) -> np.ndarray:
+    """
+    chain category (HEAVY, LIGHT or OTHERS) of every row, computed on the categories of v_call
+    """
+    v_call = v_call.astype('category')
+    categories = v_call.cat.categories
+    category_chain = np.select([categories.str.startswith('IGH'),
+                                categories.str.startswith('IGK') | categories.str.startswith('IGL')],
+                               [HEAVY, LIGHT], OTHERS)
+    return category_chain[v_call.cat.codes.to_numpy()]
+
+
+class ChainWriter():
+    """
+    Append dataframes of one chain to data_clean.feather and data_clean.csv batch by batch
+    The files are written next to the outputs and replace them on close, so the previous outputs
+    can be copied while writing
+    """
+
+    def __init__(self, outdir_path: Path, schema: pa.Schema) -> None:
+        self.feather_path = outdir_path.joinpath("data_clean.feather")
+        self.csv_path = outdir_path.joinpath("data_clean.csv")
+        self.feather_temp_path = outdir_path.joinpath("data_clean.feather.tmp")
+        self.csv_temp_path = outdir_path.joinpath("data_clean.csv.tmp")
+        self.schema = schema
+        self.writer = pa.ipc.new_file(str(self.feather_temp_path), schema,
+                                      options=pa.ipc.IpcWriteOptions(compression="lz4"))
+        self.csv_temp_path.write_text(",".join(schema.names) + "\n")
+        self.rows = 0
+
+    @staticmethod
+    def reusable(outdir_path: Path, schema: pa.Schema) -> bool:
+        """
+        the previous data_clean.feather can be copied if it exists and has the same schema
+        """
+        feather_path = outdir_path.joinpath("data_clean.feather")
+        if not feather_path.is_file():
+            return False
+        with pa.memory_map(str(feather_path)) as source:
+            return pa.ipc.open_file(source).schema.equals(schema)
+
+    def write(self, table: pa.Table) -> None:
+        if table.num_rows == 0:
+            return
+        table = table.select(self.schema.names).cast(self.schema)
+        self.writer.write_table(table)
+        # list columns are written as "_" joined values in the csv file
+        for idx, field in enumerate(table.schema):
+            if pa.types.is_list(field.type):
+                table = table.set_column(idx, field.name, pc.binary_join(
+                    table[idx].cast(pa.list_(pa.string())), "_"))
+        table.to_pandas().to_csv(self.csv_temp_path, mode='a',
+                                 header=False, index=False)
+        self.rows += table.num_rows
+
+    def copy(self, drop_samples: set) -> None:
+        """
+        append the rows of the previous data_clean.feather except the ones of drop_samples
+        """
+        drop_samples = pa.array(sorted(drop_samples), type=pa.string())
+        with pa.memory_map(str(self.feather_path)) as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i)
+                batch = batch.filter(pc.invert(
+                    pc.is_in(batch['sample_id'], value_set=drop_samples)))
+                self.write(pa.Table.from_batches([batch]))
+
+    def close(self) -> None:
+        self.writer.close()
+        self.feather_temp_path.replace(self.feather_path)
+        self.csv_temp_path.replace(self.csv_path)
+
+
 class PreProcessing():
     """
     Merge all the _airr.tsv files in the input directory into a single _airr.tsv file
     Read manifest file (file must contain patient_id column and sample_id)
     Add some additional columns: v_call_ori, j_call_ori, junction_aa_length, patient_id, sample_id, cancer_type
     Drop columns: sequence_alignment, germline_alignment, cell_id
+    Samples are read in batches of at most batch_size samples and memory_limit GB (estimated), both unbounded by default
+    If partition is set, heavy and light chains are also written as parquet datasets partitioned by v_call, j_call
+    and junction_aa_length, so the clustering stages can read one group at a time
+    _airr.tsv files may be compressed (.gz, .bgz or .zst), they are decompressed while parsing in the workers.
+    workers is the number of parsing processes, io_threads the number of read-ahead/decompression threads of each one
+    inventory_path caches the list of _airr.tsv files to avoid scanning indir_path again, only its files and the
+    directories modified since are checked on the next runs
     """
 
-    def __init__(self, indir_path: Path, gdc_path: Path, outdir_path: tuple[Path, Path]) -> None:
+    # estimated ratio between the in-memory size of a parsed _airr.tsv and its size on disk
+    AIRR_MEMORY_FACTOR = 5
+
+    def __init__(self, indir_path: Path, gdc_path: Path, outdir_path: tuple[Path, Path],
+                 batch_size: int = None, memory_limit: float = None, partition: bool = False,
+                 workers: int = None, io_threads: int = None, inventory_path: Path = None) -> None:
         logging.info("PREPROCESSING ...")
         self.indir_path = indir_path
+        self.batch_size = batch_size
+        self.memory_limit = memory_limit
+        self.partition = partition
+        self.workers = workers
+        self.io_threads = io_threads
+        self.inventory_path = inventory_path
 
         # create mapper from case_id to patient_id
         manifest = pd.read_csv(gdc_path)
@@ -37,131 +222,346 @@ class PreProcessing():
         self.outdir_heavy_path.mkdir(parents=True, exist_ok=True)
         self.outdir_light_path.mkdir(parents=True, exist_ok=True)
 
+        # integer code of each patient (patient_code column), kept across runs in patients.csv
+        self.patients_path = self.outdir_heavy_path.parent.joinpath(
+            "patients.csv")
+        self.patients = self.__patients__()
+        self.patient_codes = dict(
+            zip(self.patients['patient_id'], self.patients['patient_code'].astype(int)))
+
+    def __patients__(self) -> pd.DataFrame:
+        """
+        patient_id and patient_code of every patient: the codes of patients.csv are kept, so the rows copied from the
+        previous outputs stay valid, and the new patients of the manifest get the next codes
+        """
+        if self.patients_path.is_file():
+            patients = pd.read_csv(self.patients_path, dtype={
+                                   'patient_id': str}, keep_default_na=False)
+        else:
+            patients = pd.DataFrame(columns=PATIENT_COLUMNS)
+        new = sorted(set(self.mapper_id_patient.values()) -
+                     set(patients['patient_id']))
+        new = pd.DataFrame({'patient_id': new, 'patient_code': np.arange(
+            len(patients), len(patients) + len(new))})
+        return pd.concat([patients, new], ignore_index=True).astype({'patient_code': 'int32'})
+
     def __read_airr__(self, filename: Path) -> pd.DataFrame:
         """
         converts a filename to a pandas dataframe
+        only the used columns are decoded by the pyarrow csv engine, the gene columns are dictionary encoded
+        and the allele suffixes are stripped on the dictionaries instead of every row
         """
         if not filename.parent.name in self.mapper_id_patient.keys():
             return
         patient_id = self.mapper_id_patient[filename.parent.name]
 
-        dtypes = {'sequence_id': 'str',
-                  'sequence': 'str',
-                  'rev_comp': 'str',
-                  'productive': 'str',
-                  'v_call': 'str',
-                  'd_call': 'str',
-                  'j_call': 'str',
-                  'c_call': 'str',
-                  'cdr1': 'str',
-                  'cdr2': 'str',
-                  'junction': 'str',
-                  'junction_aa': 'str',
-                  'v_cigar': 'str',
-                  'd_cigar': 'str',
-                  'j_cigar': 'str',
-                  'v_identity': 'str',
-                  'j_identity': 'str',
-                  'complete_vdj': 'str',
-                  'consensus_count': 'int64',
-                  'sample_id': 'str',
-                  'cancer_type': 'str'}
-
-        airr = pd.read_csv(filename, sep='\t', dtype=dtypes)
-        airr = airr.dropna(
-            subset=['v_call', 'j_call', 'junction_aa'], how='any')
-
-        assert airr[['v_call', 'j_call', 'junction_aa']].isna(
-        ).sum().sum() == 0, f"{filename} There're NaN values"
-
-        airr['v_call_ori'] = airr['v_call']
-        airr['v_call'] = airr['v_call'].apply(lambda x: str(x).split("*")[0])
-
-        airr['j_call_ori'] = airr['j_call']
-        airr['j_call'] = airr['j_call'].apply(lambda x: str(x).split("*")[0])
-
-        assert airr[['v_call', 'j_call', 'junction_aa']].isna(
-        ).sum().sum() == 0, f"{filename} There're NaN values"
-
-        airr['sample_index'] = airr.index
-        airr['sample_index'] = airr['sample_index'].astype(str)
-        airr['sample_id'] = filename.parent.name
+        # one parsing thread per worker process, the i/o threads read and decompress ahead of it
+        if pa.cpu_count() != 1:
+            pa.set_cpu_count(1)
+        if self.io_threads and pa.io_thread_count() != self.io_threads:
+            pa.set_io_thread_count(self.io_threads)
+
+        airr = pyarrow.csv.read_csv(pa.input_stream(filename, compression=AIRR_COMPRESSION[airr_suffix(filename)]),
+                                    parse_options=pyarrow.csv.ParseOptions(
+                                        delimiter='\t'),
+                                    convert_options=pyarrow.csv.ConvertOptions(include_columns=list(AIRR_TYPES.keys()),
+                                                                               column_types=AIRR_TYPES,
+                                                                               strings_can_be_null=True))
+        airr = airr.append_column('sample_index', pa.array(
+            np.arange(airr.num_rows), type=pa.int64()))
+        airr = airr.filter(pc.and_(pc.and_(pc.is_valid(airr['v_call']), pc.is_valid(
+            airr['j_call'])), pc.is_valid(airr['junction_aa'])))
+
+        assert sum(airr[c].null_count for c in ['v_call', 'j_call', 'junction_aa']
+                   ) == 0, f"{filename} There're NaN values"
+
+        airr = airr.set_column(airr.schema.get_field_index('v_call'), 'v_call', map_dictionary(
+            airr['v_call'], pc.replace_substring_regex, pattern=r"\*.*", replacement=""))
+        airr = airr.set_column(airr.schema.get_field_index('j_call'), 'j_call', map_dictionary(
+            airr['j_call'], pc.replace_substring_regex, pattern=r"\*.*", replacement=""))
+        airr = airr.append_column('IG_subtypes', map_dictionary(
+            airr['c_call'], pc.utf8_slice_codeunits, start=0, stop=4))
+
+        airr = airr.to_pandas()
+        airr['sample_id'] = pd.Categorical.from_codes(
+            np.zeros(len(airr), dtype=np.int8), [filename.parent.name])
         # airr['normalized_count'] = airr['consensus_count'] / \
         #     airr['consensus_count'].sum()*1000
 
-        airr['IG_subtypes'] = airr['c_call'].str[:4]
         airr = airr[['sample_id', 'sample_index', 'v_call',
                      'j_call', 'junction_aa', 'IG_subtypes', 'consensus_count']]
-        airr['patient_id'] = patient_id
+        airr['patient_id'] = pd.Categorical.from_codes(
+            np.zeros(len(airr), dtype=np.int8), [patient_id])
+        airr['patient_code'] = np.full(
+            len(airr), self.patient_codes[patient_id], dtype=np.int32)
 
         return airr
 
+    def __batches__(self, inventory: pd.DataFrame) -> list:
+        """
+        split the files into batches bounded by batch_size (number of samples) and memory_limit (GB, estimated from the
+        file sizes). Samples are batched in sample_id order and the files of a sample stay in the same batch to keep the
+        aggregation exact. Each batch is a list of files ordered by decreasing size, for the load balancing of the pool
+        """
+        memory_limit = self.memory_limit * 1024**3 if self.memory_limit else None
+        inventory = inventory.assign(memory=inventory['size'].astype('int64') * inventory['path'].map(
+            lambda x: AIRR_COMPRESSION_RATIO.get(airr_suffix(Path(x)), 1)) * self.AIRR_MEMORY_FACTOR)
+        batches, batch, batch_memory = [], [], 0
+        for _, files in inventory.groupby('sample_id', sort=True):
+            memory = files['memory'].sum()
+            if batch and ((self.batch_size and len(batch) >= self.batch_size) or
+                          (memory_limit and batch_memory + memory > memory_limit)):
+                batches.append(batch)
+                batch, batch_memory = [], 0
+            batch.append(files)
+            batch_memory += memory
+        if batch:
+            batches.append(batch)
+        return [pd.concat(batch).sort_values('memory', ascending=False, kind='stable')['path'].map(Path).tolist()
+                for batch in batches]
+
+    def __split_aggregate__(self, df: pd.DataFrame) -> tuple:
+        """
+        classify the chains once and aggregate the heavy and light chain rows in a single groupby:
+        rows having same sample_id, v_call, j_call, junction_aa, patient_id and IG_subtypes are merged,
+        consensus_count is summed and the sample_index values are gathered into a list column
+        returns the arrow tables of heavy chains, light chains and others (not aggregated),
+        and the number of records of each chain category
+        """
+        chain = classify_chain(df['v_call'])
+        records = np.bincount(chain, minlength=3)
+        df_others = df[chain == OTHERS]
+        df = df[chain != OTHERS]
+
+        grouper = df.groupby(AGGREGATION_KEYS, observed=True)
+        # rows having NaN in the keys (e.g. IG_subtypes of an empty c_call) have no group and are not aggregated
+        group_id = grouper.ngroup().fillna(-1).to_numpy(np.int64)
+        keep = group_id >= 0
+        order = np.argsort(group_id[keep], kind='stable')
+        offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(group_id[keep], minlength=grouper.ngroups))])
+        sample_index = pa.ListArray.from_arrays(pa.array(offsets, type=pa.int32()), pa.array(
+            df['sample_index'].to_numpy(np.int64)[keep][order]))
+
+        aggregated = grouper.aggregate(
+            {"consensus_count": "sum", "patient_code": "first"}).reset_index()
+        aggregated_chain = classify_chain(aggregated['v_call'])
+        aggregated = pa.Table.from_pandas(
+            aggregated, preserve_index=False).append_column('sample_index', sample_index)
+
+        return (aggregated.filter(aggregated_chain == HEAVY),
+                aggregated.filter(aggregated_chain != HEAVY),
+                pa.Table.from_pandas(df_others, preserve_index=False),
+                records)
+
+    def __scan__(self, directory: Path) -> list:
+        """
+        (sample_id, path, size, mtime) of the _airr.tsv files under directory
+        """
+        files = []
+        for f in directory.glob('**/*_airr.tsv*'):
+            if airr_suffix(f) in AIRR_COMPRESSION:
+                stat = f.stat()
+                files.append((f.parent.name, str(f), str(
+                    stat.st_size), str(stat.st_mtime_ns)))
+        return files
+
+    def __refresh__(self, inventory: pd.DataFrame) -> pd.DataFrame:
+        """
+        stat the files of the cached inventory again: the size and mtime of the listed files are updated, the deleted
+        ones are dropped, and the sample directories (and their parents, for the new samples) modified since the
+        inventory was scanned are scanned again
+        """
+        scanned = self.inventory_path.stat().st_mtime_ns
+        files = []
+        for sample_id, path in zip(inventory['sample_id'], inventory['path']):
+            try:
+                stat = Path(path).stat()
+            except FileNotFoundError:
+                continue
+            files.append((sample_id, path, str(stat.st_size), str(stat.st_mtime_ns)))
+        directories = {Path(path).parent for path in inventory['path']}
+        directories |= {d.parent for d in directories if d != self.indir_path} | {self.indir_path}
+        changed = {d for d in directories if d.is_dir() and d.stat().st_mtime_ns >= scanned}
+        # a changed parent is scanned recursively, its changed sample directories are not scanned twice
+        changed = sorted(d for d in changed if not any(p in changed for p in d.parents))
+        for directory in changed:
+            files.extend(self.__scan__(directory))
+        if changed:
+            logging.info(f"Rescanned directories modified since the inventory: {len(changed):,d}")
+        return pd.DataFrame(files, columns=MANIFEST_COLUMNS[:-1]).drop_duplicates(
+            'path', keep='last').sort_values('path', ignore_index=True)
+
+    def __discover__(self) -> pd.DataFrame:
+        """
+        one row per _airr.tsv file: sample_id, path, size, mtime and the patient_id it is mapped to ("" if none)
+        the files come from a single scan of indir_path, or from the cached inventory_path if it exists (its files are
+        checked again and the directories modified since it was scanned are scanned again, see __refresh__),
+        and unmapped samples / manifest entries without files are reported
+        """
+        # the mtime of inventory_path is set to the start of the scan, so a directory modified during it is scanned again
+        start = time.time_ns()
+        if self.inventory_path and self.inventory_path.is_file():
+            logging.info(f"Loading sample inventory {self.inventory_path}")
+            inventory = self.__refresh__(pd.read_csv(
+                self.inventory_path, dtype=str, keep_default_na=False))
+        else:
+            inventory = pd.DataFrame(
+                self.__scan__(self.indir_path), columns=MANIFEST_COLUMNS[:-1]).sort_values('path', ignore_index=True)
+        if self.inventory_path:
+            inventory.to_csv(self.inventory_path, index=False)
+            os.utime(self.inventory_path, ns=(start, start))
+        inventory['patient_id'] = inventory['sample_id'].map(
+            self.mapper_id_patient).fillna("")
+
+        unmapped = inventory.loc[inventory['patient_id'] == "", 'sample_id'].unique()
+        if len(unmapped):
+            logging.warning(
+                f"Samples not in the manifest (skipped): {len(unmapped):,d} | {', '.join(unmapped[:10])}{' ...' if len(unmapped) > 10 else ''}")
+        missing = sorted(set(self.mapper_id_patient) -
+                         set(inventory['sample_id']))
+        if missing:
+            logging.warning(
+                f"Manifest samples without _airr.tsv file: {len(missing):,d} | {', '.join(missing[:10])}{' ...' if len(missing) > 10 else ''}")
+        return inventory
+
+    def __write_partitioned__(self, outdir_path: Path) -> Path:
+        """
+        rewrite data_clean.feather as a hive partitioned parquet dataset (v_call/j_call/junction_aa_length)
+        with row-group statistics, streaming the record batches
+        """
+        dataset_path = outdir_path.joinpath("data_clean_parquet")
+        shutil.rmtree(dataset_path, ignore_errors=True)
+        schema = AGGREGATED_SCHEMA.append(
+            pa.field('junction_aa_length', pa.int32()))
+        with pa.memory_map(str(outdir_path.joinpath("data_clean.feather"))) as source:
+            reader = pa.ipc.open_file(source)
+            batches = (reader.get_batch(i) for i in range(
+                reader.num_record_batches))
+            batches = (pa.RecordBatch.from_arrays(batch.columns + [pc.utf8_length(batch['junction_aa'])],
+                                                  schema=schema) for batch in batches)
+            ds.write_dataset(batches, dataset_path, schema=schema, format='parquet',
+                             partitioning=ds.partitioning(pa.schema(
+                                 [schema.field(c) for c in ['v_call', 'j_call', 'junction_aa_length']]), flavor='hive'),
+                             file_options=ds.ParquetFileFormat().make_write_options(write_statistics=True),
+                             max_partitions=PARQUET_MAX_PARTITIONS, preserve_order=True)
+        return dataset_path
+
     def concatenate_airr(self) -> None:
         """
         combine all _airr.tsv files into a single file
+        the samples are read in batches, each batch is split by chains, aggregated and appended to the outputs
+        so the peak memory is bounded by the batch size instead of the cohort size
+        the ingested samples are recorded in ingest_manifest.csv, a re-run only reads the new or changed samples
+        and drops the rows of the removed ones from the previous outputs
+        patient_id is dictionary encoded to the integer patient_code, recorded in patients.csv
+        the unique junctions of each chain are also encoded once in junction_store (see SequenceStore)
+        returns the paths of the heavy and light chain data (data_clean.feather or data_clean_parquet if partition)
         """
         # return self.outdir_heavy_path.joinpath("data_clean.feather"), self.outdir_light_path.joinpath("data_clean.feather")
         outdir_others_path = self.outdir_heavy_path.parent.joinpath("others")
         outdir_others_path.mkdir(parents=True, exist_ok=True)
-        if not (self.outdir_heavy_path.joinpath("data_clean.csv").is_file() and self.outdir_light_path.joinpath("data_clean.csv").is_file() and outdir_others_path.joinpath("data_clean.csv").is_file()) or True:
-            logging.info(
-                f"Merge all _airr.tsv files from {self.indir_path}")
-            total_cases = len(list(self.indir_path.glob('**/*_airr.tsv')))
-            logging.info(f"Total sample files: {total_cases:,d}")
-            logging.info(
-                f"Total unique cancer patients: {len(self.mapper_id_patient):,d}")
-
-            # have your pool map the file names to dataframes
-            df_list = p_map(self.__read_airr__, self.indir_path.glob(
-                "**/*_airr.tsv"), total=total_cases)
-
-            # reduce the list of dataframes to a single dataframe
-            df_combined = pd.concat(df_list, ignore_index=True)
-
-            logging.info(f"Total records: {len(df_combined):,d}")
-
-            df_heavy = df_combined[df_combined['v_call'].str.startswith('IGH')]
-            df_light = df_combined[(df_combined['v_call'].str.startswith(
-                'IGK')) | (df_combined['v_call'].str.startswith('IGL'))]
-            df_others = df_combined[~(df_combined.index.isin(
-                df_heavy.index) | df_combined.index.isin(df_light.index))]
-
-            logging.info(f"Writing heavy chain data IGH ...")
-            df_heavy = df_heavy.reset_index(drop=True)
-            df_heavy_no_dup = df_heavy.groupby(['sample_id', 'v_call', 'j_call', 'junction_aa', 'patient_id', 'IG_subtypes']).aggregate(
-                {"consensus_count": "sum", 'sample_index': "_".join}).reset_index()
-            df_heavy_no_dup.to_csv(self.outdir_heavy_path.joinpath(
-                "data_clean.csv"), index=False)
-            df_heavy_no_dup.to_feather(self.outdir_heavy_path.joinpath(
-                "data_clean.feather"))
+        manifest_path = self.outdir_heavy_path.parent.joinpath(
+            "ingest_manifest.csv")
+        outputs = [(self.outdir_heavy_path, AGGREGATED_SCHEMA),
+                   (self.outdir_light_path, AGGREGATED_SCHEMA),
+                   (outdir_others_path, RECORD_SCHEMA)]
+
+        logging.info(
+            f"Merge all _airr.tsv files from {self.indir_path}")
+        inventory = self.__discover__()
+        logging.info(f"Total sample files: {len(inventory):,d}")
+        logging.info(
+            f"Total unique cancer patients: {len(self.mapper_id_patient):,d}")
+
+        # the previous outputs are only reused with the patient codes they were written with
+        if manifest_path.is_file() and self.patients_path.is_file() and \
+                all(ChainWriter.reusable(path, schema) for path, schema in outputs):
+            previous = pd.read_csv(
+                manifest_path, dtype=str, keep_default_na=False)
+        else:
+            previous = pd.DataFrame(columns=MANIFEST_COLUMNS)
+        # a sample is re-ingested if any of its files (or its patient) differs from the manifest
+        changed = {i[0] for i in set(inventory.itertuples(index=False, name=None)) ^ set(
+            previous[MANIFEST_COLUMNS].itertuples(index=False, name=None))}
+        drop_samples = changed & set(previous['sample_id'])
+        # only the mapped samples are dispatched to the workers
+        inventory_read = inventory[inventory['sample_id'].isin(
+            changed) & (inventory['patient_id'] != "")]
+
+        if not changed:
+            logging.info(f"All samples are up to date in {manifest_path}")
+        else:
             logging.info(
-                f"Heavy chain records: {len(df_heavy):,d} | {len(df_heavy)/len(df_combined)*100:.2f}%")
+                f"New or changed samples: {inventory_read['sample_id'].nunique():,d} | Removed or changed samples: {len(drop_samples):,d}")
+            batches = self.__batches__(inventory_read)
+            logging.info(f"Reading samples in {len(batches):,d} batch(es)")
+
+            writer_heavy, writer_light, writer_others = [
+                ChainWriter(path, schema) for path, schema in outputs]
+            if not previous.empty:
+                for writer in [writer_heavy, writer_light, writer_others]:
+                    writer.copy(drop_samples)
+            total, total_heavy, total_light, total_others = 0, 0, 0, 0
+            for idx, batch in enumerate(batches):
+                # have your pool map the file names to dataframes
+                df_list = p_map(self.__read_airr__, batch,
+                                num_cpus=self.workers, desc=f"Batch {idx+1}/{len(batches)}")
+                df_list = [i for i in df_list if i is not None]
+                if not df_list:
+                    continue
+                df_combined = concat_categorical(df_list)
+                del df_list
+
+                df_heavy, df_light, df_others, records = self.__split_aggregate__(
+                    df_combined)
+                writer_heavy.write(df_heavy)
+                writer_light.write(df_light)
+                writer_others.write(df_others)
+
+                total += len(df_combined)
+                total_heavy += int(records[HEAVY])
+                total_light += int(records[LIGHT])
+                total_others += int(records[OTHERS])
+                del df_combined, df_heavy, df_light, df_others
+
+            writer_heavy.close()
+            writer_light.close()
+            writer_others.close()
+            self.patients.to_csv(self.patients_path, index=False)
+            inventory.to_csv(manifest_path, index=False)
+            total = max(total, 1)
+
+            logging.info(f"Total records read: {total:,d}")
             logging.info(
-                f"After aggregate duplicated records: {len(df_heavy_no_dup):,d}")
-
-            logging.info(f"Writing light chain data IGK and IGL ...")
-            df_light = df_light.reset_index(drop=True)
-            df_light_no_dup = df_light.groupby(['sample_id', 'v_call', 'j_call', 'junction_aa', 'patient_id', 'IG_subtypes']).aggregate(
-                {"consensus_count": "sum", 'sample_index': "_".join}).reset_index()
-            df_light_no_dup.to_csv(self.outdir_light_path.joinpath(
-                "data_clean.csv"), index=False)
-            df_light_no_dup.to_feather(self.outdir_light_path.joinpath(
-                "data_clean.feather"))
+                f"Heavy chain records: {total_heavy:,d} | {total_heavy/total*100:.2f}%")
             logging.info(
-                f"Light chain records: {len(df_light):,d} | {len(df_light)/len(df_combined)*100:.2f}%")
+                f"Light chain records: {total_light:,d} | {total_light/total*100:.2f}%")
             logging.info(
-                f"After aggregate duplicated records: {len(df_light_no_dup):,d}")
-
-            logging.info(f"Writing others data ...")
-            df_others = df_others.reset_index(drop=True)
-            df_others.to_csv(outdir_others_path.joinpath(
-                "data_clean.csv"), index=False)
-            df_others.to_feather(outdir_others_path.joinpath(
-                "data_clean.feather"))
+                f"Other records: {total_others:,d} | {total_others/total*100:.2f}%")
             logging.info(
-                f"Other records: {len(df_others):,d} | {len(df_others)/len(df_combined)*100:.2f}%")
+                f"Records in data_clean after aggregation: heavy {writer_heavy.rows:,d} | light {writer_light.rows:,d} | others {writer_others.rows:,d}")
+
+        # encoded junctions shared by the clustering stages
+        for outdir_path in [self.outdir_heavy_path, self.outdir_light_path]:
+            store_path = outdir_path.joinpath("junction_store")
+            if changed or not store_path.is_dir():
+                logging.info(f"Writing encoded junction store {store_path} ...")
+                SequenceStore.write(outdir_path.joinpath(
+                    "data_clean.feather"), store_path)
+
+        data_clean_paths = (self.outdir_heavy_path.joinpath("data_clean.feather"),
+                            self.outdir_light_path.joinpath("data_clean.feather"))
+        if self.partition:
+            data_clean_paths = tuple(outdir_path.joinpath("data_clean_parquet")
+                                     for outdir_path in [self.outdir_heavy_path, self.outdir_light_path])
+            for dataset_path in data_clean_paths:
+                if changed or not dataset_path.is_dir():
+                    logging.info(
+                        f"Writing partitioned parquet dataset {dataset_path} ...")
+                    self.__write_partitioned__(dataset_path.parent)
 
         logging.info(
             f"Finished preprocessing data.\n")
 
-        return self.outdir_heavy_path.joinpath("data_clean.feather"), self.outdir_light_path.joinpath("data_clean.feather")
+        return data_clean_paths
@@ -0,0 +1,90 @@
+import os
+import time
+import logging
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from p_tqdm import p_umap
+
+
+class Scheduler():
+    """
+    Size-aware dispatch of tasks to a process pool
+    Each task has an estimated cost. Tasks are dispatched one at a time by decreasing cost, so the largest ones start first
+    and the small ones fill the idle workers at the end. Tasks costing less than a share of the total (batch_share of the
+    average work per worker) are packed into batches of about that cost, so tiny tasks don't pay one dispatch each.
+    The time of every task is recorded, report() logs the slowest ones and writes them all to a csv file
+    """
+
+    def __init__(self, workers: int = None, batch_share: float = 1 / 8) -> None:
+        self.workers = workers or os.cpu_count()
+        self.batch_share = batch_share
+        self.timings = []
+
+    @staticmethod
+    def __run__(batch):
+        func, tasks = batch
+        results = []
+        for index, task in tasks:
+            start = time.perf_counter()
+            result = func(task)
+            results.append((index, result, time.perf_counter() - start))
+        return results
+
+    def __batches__(self, costs: np.ndarray) -> list:
+        """
+        lists of task indices, largest tasks first, tasks below the batch cost packed together
+        """
+        order = np.argsort(-costs, kind='stable')
+        batch_cost = costs.sum() / self.workers * self.batch_share
+        batches, batch, total = [], [], 0
+        for index in order:
+            if costs[index] >= batch_cost:
+                batches.append([index])
+                continue
+            batch.append(index)
+            total += costs[index]
+            if total >= batch_cost:
+                batches.append(batch)
+                batch, total = [], 0
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def map(self, func, tasks: list, costs) -> list:
+        """
+        results of func over the tasks, in the order of the tasks
+        """
+        if not tasks:
+            return []
+        costs = np.asarray(costs, dtype=np.float64)
+        batches = self.__batches__(costs)
+        logging.info(
+            f"Scheduling {len(tasks):,d} tasks in {len(batches):,d} batches on {self.workers} workers, largest first")
+        start = time.perf_counter()
+        done = p_umap(self.__run__, [(func, [(i, tasks[i]) for i in batch]) for batch in batches],
+                      num_cpus=self.workers)
+        wall = time.perf_counter() - start
+
+        results = [None] * len(tasks)
+        busy = 0
+        for index, result, seconds in (i for batch in done for i in batch):
+            results[index] = result
+            busy += seconds
+            self.timings.append((func.__name__, index, costs[index], seconds))
+        logging.info(
+            f"Tasks took {busy:,.1f}s of work in {wall:,.1f}s on {self.workers} workers ({busy / max(wall * self.workers, 1e-9):.0%} busy)")
+        return results
+
+    def report(self, path: Path, top: int = 5) -> None:
+        """
+        log the slowest tasks and write all the timings
+        """
+        if not self.timings:
+            return
+        timings = pd.DataFrame(self.timings, columns=['step', 'task', 'cost', 'seconds'])
+        timings = timings.sort_values(by=['seconds'], ascending=False)
+        for _, i in timings.head(top).iterrows():
+            logging.info(
+                f"Slowest task: {i['step']} #{i['task']} (cost {i['cost']:,.0f}) in {i['seconds']:,.2f}s")
+        timings.round(5).to_csv(path, index=False)
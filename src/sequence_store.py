@@ -0,0 +1,82 @@
+from pathlib import Path
+import shutil
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather
+
+
+def encode_junctions(junctions, length: int) -> np.ndarray:
+    """
+    encode junctions of the same length as an (n, length) uint8 matrix of ASCII codes
+    """
+    return np.asarray(junctions, dtype=f"S{length}").view(np.uint8).reshape(-1, length)
+
+
+class SequenceStore():
+    """
+    Integer-encoded junction_aa of a cleaned chain table
+    For each junction length L, junction_store/length_{L}.npy is a contiguous (n, L) uint8 matrix of the ASCII codes
+    of the sorted unique junctions of that length. The sorted rows are the dictionary of the store: a junction is
+    found by binary search on the rows viewed as fixed-size byte strings. The matrices are memory-mapped, so every
+    process opening the store shares the same pages
+    """
+
+    def __init__(self, store_path: Path) -> None:
+        self.store_path = Path(store_path)
+        self.matrices = {}
+
+    @staticmethod
+    def write(data_clean_path: Path, store_path: Path) -> None:
+        """
+        build the store from the junction_aa column of data_clean.feather
+        """
+        junctions = pyarrow.feather.read_table(
+            data_clean_path, columns=['junction_aa'])['junction_aa']
+        junctions = pc.unique(junctions).cast(pa.binary())
+        lengths = pc.binary_length(junctions).to_numpy(zero_copy_only=False)
+        junctions = junctions.to_numpy(zero_copy_only=False)
+
+        temp_path = store_path.with_name(store_path.name + ".tmp")
+        shutil.rmtree(temp_path, ignore_errors=True)
+        temp_path.mkdir(parents=True)
+        for length in np.unique(lengths):
+            matrix = np.sort(junctions[lengths == length].astype(
+                f"S{length}")).view(np.uint8).reshape(-1, length)
+            np.save(temp_path.joinpath(f"length_{length}.npy"), matrix)
+        shutil.rmtree(store_path, ignore_errors=True)
+        temp_path.rename(store_path)
+
+    def __getstate__(self):
+        # the memory maps are re-opened by each process instead of being pickled
+        return {'store_path': self.store_path, 'matrices': {}}
+
+    def lengths(self) -> list:
+        return sorted(int(f.stem.split("_")[1]) for f in self.store_path.glob("length_*.npy"))
+
+    def matrix(self, length: int) -> np.ndarray:
+        """
+        memory-mapped matrix of the junctions of this length
+        """
+        if length not in self.matrices:
+            self.matrices[length] = np.load(self.store_path.joinpath(
+                f"length_{length}.npy"), mmap_mode='r')
+        return self.matrices[length]
+
+    def rows(self, junctions, length: int) -> np.ndarray:
+        """
+        row of each junction in the matrix of its length
+        """
+        keys = self.matrix(length).view(f"S{length}").ravel()
+        query = np.asarray(junctions, dtype=f"S{length}")
+        rows = np.minimum(np.searchsorted(keys, query), max(len(keys) - 1, 0))
+        if len(query) and (len(keys) == 0 or (keys[rows] != query).any()):
+            raise KeyError(
+                f"Junctions of length {length} are missing from {self.store_path}")
+        return rows
+
+    def encode(self, junctions, length: int) -> np.ndarray:
+        """
+        encoded matrix of the junctions gathered from the store
+        """
+        return np.asarray(self.matrix(length)[self.rows(junctions, length)])
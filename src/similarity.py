@@ -0,0 +1,142 @@
+import numpy as np
+import pandas as pd
+
+# number of mismatch cells computed at once when comparing blocks of sequences
+BLOCK_CELLS = 1 << 24
+# groups from this number of sequences are searched with the segment index instead of comparing all pairs
+INDEX_MIN_ROWS = 2048
+
+
+def max_mismatches(length: int, similarity_threshold: float) -> int:
+    """
+    largest number of mismatches k such that the similarity (length - k) / length is still >= similarity_threshold
+    """
+    k = -1
+    while k < length and (length - k - 1) / length >= similarity_threshold:
+        k += 1
+    return k
+
+
+def similar_pairs(matrix: np.ndarray, similarity_threshold: float) -> tuple:
+    """
+    all pairs (i, j), i < j, of rows of an encoded (n, length) matrix having a hamming similarity >= similarity_threshold
+    large matrices are searched with the segment index (indexed_pairs), the others by comparing all pairs (all_pairs)
+    returns the row and column indices ordered by (i, j), and the number of mismatches of each pair
+    """
+    n, length = matrix.shape
+    k = max_mismatches(length, similarity_threshold)
+    if k < 0 or n < 2:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    if n >= INDEX_MIN_ROWS and k < length:
+        return indexed_pairs(matrix, k)
+    return all_pairs(matrix, k)
+
+
+def all_pairs(matrix: np.ndarray, k: int) -> tuple:
+    """
+    pairs of rows having at most k mismatches, the mismatches are computed by broadcasting a block of rows against the
+    following rows, the block size keeps the temporary (block, n, length) array around BLOCK_CELLS
+    """
+    n, length = matrix.shape
+    rows, cols, mismatches = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+    block = max(1, BLOCK_CELLS // (n * length))
+    for start in range(0, n - 1, block):
+        stop = min(start + block, n - 1)
+        distance = (matrix[start:stop, None, :] != matrix[None, start + 1:, :]).sum(axis=2)
+        i, j = np.nonzero(distance <= k)
+        # distance[i, j] compares row start+i with row start+1+j, keep the upper triangle only
+        keep = j >= i
+        i, j = i[keep], j[keep]
+        rows.append(i + start)
+        cols.append(j + start + 1)
+        mismatches.append(distance[i, j])
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(mismatches)
+
+
+def segments(matrix: np.ndarray, k: int) -> list:
+    """
+    split the positions of the sequences of an encoded matrix into k + 1 segments (arrays of positions) of about the
+    same entropy, so that conserved positions (e.g. the leading C of the junctions) don't make one segment useless
+    """
+    n, length = matrix.shape
+    entropy = np.empty(length)
+    for position in range(length):
+        p = np.bincount(matrix[:, position], minlength=256) / n
+        p = p[p > 0]
+        entropy[position] = -(p * np.log(p)).sum()
+    # longest processing time first: the next most diverse position goes to the least diverse segment
+    positions, totals = [[] for _ in range(k + 1)], np.zeros(k + 1)
+    for position in np.argsort(-entropy, kind='stable'):
+        s = int(np.argmin(totals))
+        positions[s].append(position)
+        totals[s] += entropy[position]
+    return [np.sort(np.array(p, dtype=np.int64)) for p in positions]
+
+
+def indexed_pairs(matrix: np.ndarray, k: int) -> tuple:
+    """
+    pairs of rows having at most k mismatches, searched with a pigeonhole index: the positions are split into k + 1
+    segments, and two sequences with at most k mismatches are identical on at least one of them.
+    For each segment, the rows are sorted by their segment, the rows sharing a segment are the candidate pairs, and
+    only the candidates are compared. A pair is kept by the first segment it is identical on, so it is found once.
+    Candidates are compared by blocks of about BLOCK_CELLS cells
+    """
+    n, length = matrix.shape
+    positions = segments(matrix, k)
+    rows, cols, mismatches = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+    block = max(1, BLOCK_CELLS // length)
+    for s in range(k + 1):
+        segment = np.ascontiguousarray(matrix[:, positions[s]])
+        keys = segment.view(f"S{segment.shape[1]}").ravel() if segment.shape[1] else np.zeros(n, dtype="S1")
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        # each row is a candidate with the following rows of the same segment
+        counts = np.searchsorted(keys, keys, side='right') - np.arange(n) - 1
+        cumulative = np.cumsum(counts)
+        start = 0
+        while start < n:
+            # rows [start, stop) produce about block candidates
+            stop = min(n, max(start + 1, int(np.searchsorted(
+                cumulative, cumulative[start] - counts[start] + block, side='right'))))
+            c = counts[start:stop]
+            first = np.repeat(np.arange(start, stop), c)
+            second = first + 1 + np.arange(c.sum()) - np.repeat(np.cumsum(c) - c, c)
+            i, j = order[first], order[second]
+            i, j = np.minimum(i, j), np.maximum(i, j)
+            different = matrix[i] != matrix[j]
+            distance = different.sum(axis=1)
+            keep = distance <= k
+            # drop the pairs identical on an earlier segment, they were found there
+            for t in range(s):
+                keep &= different[:, positions[t]].any(axis=1)
+            rows.append(i[keep])
+            cols.append(j[keep])
+            mismatches.append(distance[keep])
+            start = stop
+    rows, cols, mismatches = np.concatenate(rows), np.concatenate(cols), np.concatenate(mismatches)
+    order = np.lexsort((cols, rows))
+    return rows[order], cols[order], mismatches[order]
+
+
+def blosum_groups(blosum: pd.DataFrame) -> np.ndarray:
+    """
+    compile the BLOSUM table into a (256, 256) boolean table indexed by the ASCII codes of two amino acids,
+    True if their score is positive (same amino acid group). Unknown amino acids are never in the same group
+    """
+    table = np.zeros((256, 256), dtype=bool)
+    table[np.ix_([ord(i) for i in blosum.index], [ord(i) for i in blosum.columns])] = blosum.to_numpy() > 0
+    return table
+
+
+def same_group(matrix: np.ndarray, rows: np.ndarray, cols: np.ndarray, groups: np.ndarray) -> np.ndarray:
+    """
+    for each pair (rows[p], cols[p]) of rows of an encoded matrix, True if the amino acids are in the same group
+    at all positions. The pairs are gathered by blocks of about BLOCK_CELLS cells
+    """
+    mask = np.empty(len(rows), dtype=bool)
+    block = max(1, BLOCK_CELLS // max(matrix.shape[1], 1))
+    for start in range(0, len(rows), block):
+        stop = start + block
+        mask[start:stop] = groups[matrix[rows[start:stop]],
+                                  matrix[cols[start:stop]]].all(axis=1)
+    return mask
@@ -0,0 +1,61 @@
+import hashlib
+import json
+from pathlib import Path
+
+# modules whose code defines the results of the clustering stages
+CODE_MODULES = ['clustering_exact', 'clustering_graph', 'clustering_similar', 'clustering_convergence',
+                'clustering_combined', 'clique', 'similarity', 'patients', 'group_reader', 'cluster_store',
+                'sequence_store', 'scheduler', 'stage_cache']
+
+
+def file_digest(path: Path) -> str:
+    """
+    hash of the content of a file, or of the files of a directory (e.g. a parquet dataset) with their relative paths
+    """
+    path = Path(path)
+    digest = hashlib.blake2b(digest_size=16)
+    files = sorted(i for i in path.rglob("*") if i.is_file()) if path.is_dir() else [path]
+    for f in files:
+        digest.update(str(f.relative_to(path) if path.is_dir() else f.name).encode())
+        with open(f, 'rb') as handle:
+            for chunk in iter(lambda: handle.read(1 << 24), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def code_version() -> str:
+    """
+    hash of the code of the clustering modules
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for module in CODE_MODULES:
+        digest.update(Path(__file__).with_name(f"{module}.py").read_bytes())
+    return digest.hexdigest()
+
+
+class StageCache():
+    """
+    Fingerprint of the inputs of a clustering stage (data_clean content hash, parameters and code version), recorded
+    in {stage_path}/fingerprint.json once the stage is done. The stage is skipped on the next run only if the fingerprint
+    matches, it is removed before the stage runs so an interrupted stage is never reused
+    """
+
+    def __init__(self, stage_path: Path, inputs: dict) -> None:
+        self.fingerprint_path = Path(stage_path).joinpath("fingerprint.json")
+        self.fingerprint = {**inputs, 'code_version': code_version()}
+
+    def valid(self) -> bool:
+        if not self.fingerprint_path.is_file():
+            return False
+        with open(self.fingerprint_path) as handle:
+            try:
+                return json.load(handle) == self.fingerprint
+            except json.JSONDecodeError:
+                return False
+
+    def invalidate(self) -> None:
+        self.fingerprint_path.unlink(missing_ok=True)
+
+    def record(self) -> None:
+        with open(self.fingerprint_path, 'w') as handle:
+            json.dump(self.fingerprint, handle, indent=2)
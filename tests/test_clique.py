@@ -0,0 +1,100 @@
+import sys
+from pathlib import Path
+
+import networkx as nx
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.joinpath("src")))
+from clique import clique_partition, connected_components  # noqa: E402
+from clustering_similar import ClusteringSimilar  # noqa: E402
+
+
+def __random_graph__(seed: int, n: int, density: float) -> tuple:
+    rng = np.random.default_rng(seed)
+    rows, cols = np.triu_indices(n, 1)
+    keep = rng.random(len(rows)) < density
+    return rng, rows[keep], cols[keep]
+
+
+def __graph__(n: int, rows: np.ndarray, cols: np.ndarray, weights: np.ndarray = None) -> nx.Graph:
+    graph = nx.Graph()
+    graph.add_nodes_from((v, {'weight': 1 if weights is None else int(weights[v])}) for v in range(n))
+    graph.add_edges_from(zip(rows.tolist(), cols.tolist()))
+    return graph
+
+
+@pytest.mark.parametrize("seed", range(60))
+def test_clique_partition_takes_a_heaviest_clique_at_each_step(seed):
+    n = 4 + seed % 20
+    rng, rows, cols = __random_graph__(seed, n, [0.2, 0.5, 0.8][seed % 3])
+    weights = rng.integers(1, 4, n) if seed % 2 else None
+    clusters, fallback, _ = clique_partition(n, rows, cols, weights)
+    assert fallback is None
+
+    graph = __graph__(n, rows, cols, weights)
+    for cluster in clusters:
+        _, heaviest = nx.max_weight_clique(graph, weight='weight')
+        sub = graph.subgraph(cluster)
+        assert sub.number_of_edges() == len(cluster) * (len(cluster) - 1) // 2
+        assert sum(w for _, w in sub.nodes(data='weight')) == heaviest
+        graph.remove_nodes_from(cluster)
+    # nothing of weight 2 is left
+    assert graph.number_of_nodes() == 0 or nx.max_weight_clique(graph, weight='weight')[1] < 2
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_clique_partition_budget_fallback_gives_disjoint_cliques(seed):
+    n = 30
+    _, rows, cols = __random_graph__(seed, n, 0.6)
+    clusters, fallback, steps = clique_partition(n, rows, cols, budget=5)
+    assert fallback is not None and steps == 5
+    graph = __graph__(n, rows, cols)
+    nodes = [v for cluster in clusters for v in cluster]
+    assert len(nodes) == len(set(nodes))
+    for cluster in clusters:
+        assert graph.subgraph(cluster).number_of_edges() == len(cluster) * (len(cluster) - 1) // 2
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_connected_components_match_networkx(seed):
+    n = 1 + seed * 7
+    _, rows, cols = __random_graph__(seed, n, 2 / max(n, 1))
+    labels = connected_components(n, rows, cols)
+    for component in nx.connected_components(__graph__(n, rows, cols)):
+        # the label of a component is its smallest node
+        assert set(labels[list(component)]) == {min(component)}
+
+
+def __prune_reference__(n, node, codes, rows, cols, patient_min, prune_nodes):
+    """
+    the nodes kept by dropping the components, then (with prune_nodes) the nodes whose closed neighbourhood among the
+    nodes kept has less than patient_min patients, one at a time until none is left
+    """
+    graph = __graph__(n, rows, cols)
+    patients = [set(codes[node == v]) for v in range(n)]
+    keep = set()
+    for component in nx.connected_components(graph):
+        if len(set().union(*(patients[v] for v in component))) >= patient_min:
+            keep |= component
+    while prune_nodes:
+        drop = next((v for v in sorted(keep) if len(set().union(
+            patients[v], *(patients[u] for u in graph[v] if u in keep))) < patient_min), None)
+        if drop is None:
+            break
+        keep.remove(drop)
+    return keep
+
+
+@pytest.mark.parametrize("seed", range(80))
+def test_prune_reaches_the_reference_fixed_point(seed):
+    n = 2 + seed % 25
+    rng, rows, cols = __random_graph__(seed, n, [0.05, 0.15, 0.4][seed % 3])
+    node = np.repeat(np.arange(n), rng.integers(1, 3, n))
+    codes = rng.integers(0, 2 + seed % 5, len(node))
+    for prune_nodes in (False, True):
+        stage = object.__new__(ClusteringSimilar)
+        stage.patient_min, stage.prune_nodes, stage.cluster_mode = 2 + seed % 3, prune_nodes, 'clique'
+        keep = stage.__prune__(n, node, codes, rows, cols)
+        assert set(np.flatnonzero(keep)) == __prune_reference__(n, node, codes, rows, cols,
+                                                                stage.patient_min, prune_nodes)
@@ -0,0 +1,26 @@
+import os
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.joinpath("src")))
+from group_reader import GroupReader  # noqa: E402
+
+
+def __write_data_clean__(path: Path, junctions: list) -> None:
+    pd.DataFrame({'v_call': 'IGHV1-2', 'j_call': 'IGHJ4', 'junction_aa': junctions,
+                  'patient_code': range(len(junctions))}).to_feather(path)
+
+
+def test_groups_copy_is_rewritten_when_data_clean_changes(tmp_path):
+    data_clean = tmp_path.joinpath("data_clean.feather")
+    __write_data_clean__(data_clean, ['CARW', 'CTRW'])
+    reader = GroupReader(data_clean)
+    assert reader.load(reader.groups()[0])['junction_aa'].tolist() == ['CARW', 'CTRW']
+
+    # a data_clean older than the sorted copy (e.g. restored from a backup) must not be served from the copy
+    __write_data_clean__(data_clean, ['CASW', 'CTSW', 'CVSW'])
+    os.utime(data_clean, ns=(0, 0))
+    reader = GroupReader(data_clean)
+    assert reader.load(reader.groups()[0])['junction_aa'].tolist() == ['CASW', 'CTSW', 'CVSW']
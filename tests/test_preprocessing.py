@@ -0,0 +1,60 @@
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.joinpath("src")))
+from preprocessing import PreProcessing  # noqa: E402
+
+
+def test_split_aggregate_drops_empty_c_call():
+    # an empty c_call gives a NaN IG_subtypes key, the row is dropped as by a plain groupby
+    df = pd.DataFrame({'sample_id': ['s1'] * 3,
+                       'sample_index': [0, 1, 2],
+                       'v_call': ['IGHV1-2'] * 3,
+                       'j_call': ['IGHJ4'] * 3,
+                       'junction_aa': ['CARW'] * 3,
+                       'IG_subtypes': ['IGHM', None, 'IGHM'],
+                       'consensus_count': [1, 2, 3],
+                       'patient_id': ['P1'] * 3,
+                       'patient_code': np.zeros(3, dtype=np.int32)})
+    heavy, light, others, _ = object.__new__(PreProcessing).__split_aggregate__(df)
+    heavy = heavy.to_pandas()
+    assert len(heavy) == 1 and light.num_rows == 0 and others.num_rows == 0
+    assert heavy['consensus_count'].tolist() == [4]
+    assert heavy['sample_index'].iloc[0].tolist() == [0, 2]
+
+
+def __write_airr__(path: Path, junctions: list) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    pd.DataFrame({'v_call': 'IGHV1-2*02', 'j_call': 'IGHJ4*02', 'c_call': 'IGHM',
+                  'junction_aa': junctions, 'consensus_count': 1}).to_csv(path, sep='\t', index=False)
+
+
+def __junctions__(outdir: Path) -> list:
+    return sorted(pd.read_feather(outdir.joinpath("heavy", "data_clean.feather"))['junction_aa'])
+
+
+def test_inventory_picks_up_changed_and_new_files(tmp_path):
+    indir, outdir = tmp_path.joinpath("airr"), tmp_path.joinpath("out")
+    __write_airr__(indir.joinpath("S1", "S1_airr.tsv"), ['CARW'])
+    manifest = tmp_path.joinpath("manifest.csv")
+    pd.DataFrame({'sample_id': ['S1', 'S2'], 'patient_id': ['P1', 'P2']}).to_csv(manifest, index=False)
+    inventory = tmp_path.joinpath("inventory.csv")
+
+    def run():
+        PreProcessing(indir, manifest, (outdir.joinpath("heavy"), outdir.joinpath("light")),
+                      workers=1, inventory_path=inventory).concatenate_airr()
+
+    run()
+    assert __junctions__(outdir) == ['CARW']
+
+    # a listed file is rewritten and a sample is added after the inventory was cached
+    time.sleep(0.01)
+    __write_airr__(indir.joinpath("S1", "S1_airr.tsv"), ['CARW', 'CTRW'])
+    __write_airr__(indir.joinpath("S2", "S2_airr.tsv"), ['CASW'])
+    run()
+    assert __junctions__(outdir) == ['CARW', 'CASW', 'CTRW']
+    assert sorted(pd.read_csv(inventory)['sample_id']) == ['S1', 'S2']
@@ -0,0 +1,48 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.joinpath("src")))
+import similarity  # noqa: E402
+from similarity import all_pairs, indexed_pairs, similar_pairs  # noqa: E402
+
+
+def __brute_force__(matrix: np.ndarray, k: int) -> tuple:
+    n = len(matrix)
+    pairs = [(i, j, int((matrix[i] != matrix[j]).sum())) for i in range(n) for j in range(i + 1, n)]
+    pairs = [p for p in pairs if p[2] <= k]
+    return tuple(np.array([p[c] for p in pairs], dtype=np.int64) for c in range(3))
+
+
+def __random_matrix__(seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    n, length = int(rng.integers(2, 120)), int(rng.integers(1, 16))
+    # a small alphabet, and a few copies with mutations, so that there are many close pairs
+    matrix = rng.integers(0, 2 + seed % 4, (n, length)).astype(np.uint8)
+    copies = rng.integers(0, n, n // 2)
+    mutated = matrix[copies].copy()
+    mutated[np.arange(len(copies)), rng.integers(0, length, len(copies))] = 20
+    return np.concatenate([matrix, mutated])
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_indexed_pairs_equal_all_pairs_and_brute_force(seed):
+    matrix = __random_matrix__(seed)
+    for k in range(min(4, matrix.shape[1])):
+        expected = __brute_force__(matrix, k)
+        for found in (all_pairs(matrix, k), indexed_pairs(matrix, k)):
+            # same pairs, same mismatches, ordered by (i, j)
+            for a, b in zip(found, expected):
+                np.testing.assert_array_equal(a, b)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_similar_pairs_with_the_index(seed, monkeypatch):
+    matrix = __random_matrix__(seed)
+    threshold = [0.6, 0.75, 0.9][seed % 3]
+    expected = similar_pairs(matrix, threshold)
+    monkeypatch.setattr(similarity, 'INDEX_MIN_ROWS', 2)
+    for a, b in zip(similar_pairs(matrix, threshold), expected):
+        np.testing.assert_array_equal(a, b)